@@ -0,0 +1,240 @@
+import asyncio
+import functools
+import json
+import logging as log
+from collections import namedtuple
+
+from detection import detect_rectangles, detect_rectangles_tiled, detect_text, detect_text_tiled, detect_text_batch, \
+    join_padded_rectangles, detect_buttons, detect_check_buttons, detect_radial_buttons, detect_radial_button_circles, \
+    OcrRegistry, clean_ocr_text, crop_padded_roi, image_context, OCR_CONFIG
+from metrics import increment
+from ocr import get_ocr_backend, ocr_rois_async
+from utils import rectangle, run_stage_graph, timer
+
+
+# Everything analyze_image depends on besides the pixels and the model, the cache key of the results is built from it
+ANALYSIS_PARAMETERS = {
+    'min_confidence': 0.1,
+    'join_padding': (0.05, 0.05),
+    'adaptive_threshold_block_size': 11,
+    'adaptive_threshold_c': 2,
+    'rectangle_area_thresh': 50,
+    'rectangle_coef': 0.0,
+    'debug_ocr_padding': (0.1, 0.1),
+    'button_ocr_padding': (0.0, 0.0),
+    'label_ocr_padding': (0.1, 0.1),
+}
+
+
+# Large images are analyzed in overlapping tiles of size x size pixels, workers tiles at a time
+tiling = namedtuple('tiling', 'size overlap workers')
+
+
+def needs_tiling(image, tiles):
+    return tiles is not None and max(image.shape[:2]) > tiles.size
+
+
+def _text_stage(context, model_path, tiles):
+    def text_stage():
+        if needs_tiling(context, tiles):
+            return detect_text_tiled(context, model_path, ANALYSIS_PARAMETERS['min_confidence'], *tiles)
+        return detect_text(context, model_path, ANALYSIS_PARAMETERS['min_confidence'])
+
+    return text_stage
+
+
+def analyze_image(image, model_path, debug=False, mosaic_ocr=False, ocr_workers=1, stage_workers=4, tiles=None):
+    # One context for the whole analysis, every plane of the image is computed once whatever the stages needing it
+    context = image_context(image)
+    return _analyze(context, _text_stage(context, model_path, tiles), debug, mosaic_ocr, ocr_workers, stage_workers,
+                    tiles)
+
+
+async def analyze_image_async(image, model_path, debug=False, stage_workers=4, tiles=None, executor=None,
+                              ocr_semaphore=None):
+    # The OpenCV and network stages run in the executor, the OCR runs in tesseract subprocesses that the event loop
+    # waits on. At most ocr_semaphore subprocesses run at the same time over all the images in flight.
+    loop = asyncio.get_running_loop()
+    context = image_context(image)
+
+    with timer('Analysis', 'analysis'):
+        stage_results = await loop.run_in_executor(executor, functools.partial(
+            _detect_widgets, context, _text_stage(context, model_path, tiles), stage_workers, tiles))
+        results, registry, ocr_targets = _request_ocr(stage_results, debug)
+
+        with timer('Stage ocr'):
+            registry.fill(await ocr_rois_async(registry.pending_rois(context), OCR_CONFIG, ocr_semaphore))
+        _finish_ocr(context, stage_results, registry, ocr_targets, debug)
+
+    increment('images_analyzed')
+    return results
+
+
+def analyze_images(images, model_path, debug=False, batch_size=8, pad=False, mosaic_ocr=False, ocr_workers=1,
+                   stage_workers=4):
+    # The text detection of all the images is batched, the rest of the pipeline runs image by image
+    contexts = [image_context(image) for image in images]
+    batch_net_results = detect_text_batch(contexts, model_path, ANALYSIS_PARAMETERS['min_confidence'], batch_size, pad)
+
+    return [analyze_text_results(context, net_results, debug, mosaic_ocr, ocr_workers, stage_workers)
+            for context, net_results in zip(contexts, batch_net_results)]
+
+
+def analyze_text_results(image, net_results, debug=False, mosaic_ocr=False, ocr_workers=1, stage_workers=4):
+    return _analyze(image, lambda: net_results, debug, mosaic_ocr, ocr_workers, stage_workers)
+
+
+def analyze_text_future(image, text_future, debug=False, mosaic_ocr=False, ocr_workers=1, stage_workers=4):
+    # The text detection runs elsewhere, like in a batch of the analysis server, and the other stages don't wait for it
+    return _analyze(image, text_future.result, debug, mosaic_ocr, ocr_workers, stage_workers)
+
+
+def _analyze(image, text_stage, debug, mosaic_ocr, ocr_workers, stage_workers, tiles=None):
+    with timer('Analysis', 'analysis'):
+        results = _analyze_stages(image_context(image), text_stage, debug, mosaic_ocr, ocr_workers, stage_workers, tiles)
+    increment('images_analyzed')
+    return results
+
+
+def _analyze_stages(context, text_stage, debug, mosaic_ocr, ocr_workers, stage_workers, tiles=None):
+    stage_results = _detect_widgets(context, text_stage, stage_workers, tiles)
+    results, registry, ocr_targets = _request_ocr(stage_results, debug)
+
+    # The labels of all the widgets and the debug texts are recognized together, so the OCR engine can batch them
+    with timer('Stage ocr'):
+        registry.resolve(context, mosaic=mosaic_ocr, workers=ocr_workers)
+    _finish_ocr(context, stage_results, registry, ocr_targets, debug)
+    log.info("Applying ocr on buttons, check buttons and radial buttons finished")
+
+    return results
+
+
+def _detect_widgets(context, text_stage, stage_workers, tiles=None):
+    parameters = ANALYSIS_PARAMETERS
+    threshold_parameters = (parameters['adaptive_threshold_block_size'], parameters['adaptive_threshold_c'])
+
+    def text_rects_stage():
+        return join_padded_rectangles(text_stage(), parameters['join_padding'], context.shape[:2])
+
+    def rectangles_stage():
+        if needs_tiling(context, tiles):
+            return detect_rectangles_tiled(context, parameters['rectangle_area_thresh'], parameters['rectangle_coef'],
+                                           *tiles, block_size=threshold_parameters[0], c=threshold_parameters[1])
+        return detect_rectangles(context, parameters['rectangle_area_thresh'], parameters['rectangle_coef'],
+                                 block_size=threshold_parameters[0], c=threshold_parameters[1])
+
+    def circles_stage():
+        return detect_radial_button_circles(context)
+
+    # The button detection draws on the image, the planes the other detectors need are derived before it runs since
+    # it waits for the rectangles
+    def buttons_stage(rectangles, text_rects):
+        buttons = detect_buttons(context, rectangles, text_rects)
+        log.info("Completed detect buttons function")
+        return buttons
+
+    def check_buttons_stage(rectangles, text_rects):
+        check_buttons = detect_check_buttons(context, rectangles, text_rects)
+        log.info("Completed detect check buttons function")
+        return check_buttons
+
+    def radial_buttons_stage(text_rects, circles):
+        radial_buttons = detect_radial_buttons(context, text_rects, circles)
+        log.info("Completed detect radial buttons function")
+        return radial_buttons
+
+    # The text detection, the rectangle detection and the circle detection don't depend on each other and OpenCV
+    # releases the GIL, so they run at the same time. The gray plane they share is computed by the first one asking
+    # for it. Only the matching waits for its inputs.
+    stages = {
+        'text_rects': (text_rects_stage, []),
+        'rectangles': (rectangles_stage, []),
+        'circles': (circles_stage, []),
+        'buttons': (buttons_stage, ['rectangles', 'text_rects']),
+        'check_buttons': (check_buttons_stage, ['rectangles', 'text_rects']),
+        'radial_buttons': (radial_buttons_stage, ['text_rects', 'circles']),
+    }
+
+    return run_stage_graph(stages, stage_workers)
+
+
+def _request_ocr(stage_results, debug):
+    # Registers every region to recognize: the label of every widget and, in debug mode, every text rectangle
+    parameters = ANALYSIS_PARAMETERS
+    registry = OcrRegistry()
+
+    results = {
+        'buttons': stage_results['buttons'],
+        'check_buttons': stage_results['check_buttons'],
+        'radial_buttons': stage_results['radial_buttons'],
+    }
+
+    ocr_targets = []
+    for button in results['buttons']:
+        text_rect = rectangle.from_json(button['rectangle'])
+        ocr_targets.append((button, registry.request(text_rect, parameters['button_ocr_padding'])))
+
+    for check_button in results['check_buttons']:
+        text_rect = check_button['associated_text_rect']
+
+        if text_rect:
+            text_rect = rectangle.from_json(text_rect)
+            ocr_targets.append((check_button, registry.request(text_rect, parameters['label_ocr_padding'])))
+        else:
+            check_button['text'] = None
+
+    for radial_button in results['radial_buttons']:
+        text_rect = rectangle.from_json(radial_button['associated_text_rect'])
+        ocr_targets.append((radial_button, registry.request(text_rect, parameters['label_ocr_padding'])))
+
+    # The debug texts are read from the gray plane, derived before the button detection drew on the image
+    if debug:
+        for text_rect in stage_results['text_rects']:
+            registry.request(text_rect, parameters['debug_ocr_padding'], 'gray')
+
+    return results, registry, ocr_targets
+
+
+def _finish_ocr(context, stage_results, registry, ocr_targets, debug):
+    for widget, region in ocr_targets:
+        widget['text'] = clean_ocr_text(registry.text(*region))
+
+    if debug:
+        _write_debug_json(context.image, stage_results, registry)
+
+    log.info(f'OCR registry: {registry.requests} requests, {registry.saved_calls} served by an earlier region')
+
+
+def _write_debug_json(image, stage_results, registry):
+    padding = ANALYSIS_PARAMETERS['debug_ocr_padding']
+
+    texts = []
+    for rect in stage_results['text_rects']:
+        text = registry.text(rect, padding, 'gray')
+        if text:
+            start_x, start_y = crop_padded_roi(image, rect, padding)[1]
+            texts.append({'text': text, 'rectangle': rectangle(start_x, start_y, rect.w, rect.h).to_json()})
+
+    debug_json = {
+        'rectangles': [rect.to_json() for rect in stage_results['rectangles']],
+        'texts': texts
+    }
+    with open('debug.json', 'w') as file:
+        file.write(json.dumps(debug_json, indent=2))
+
+
+def analyze_image_cached(image, model_path, cache, mosaic_ocr=False, ocr_workers=1, tiles=None):
+    parameters = dict(ANALYSIS_PARAMETERS, ocr_backend=get_ocr_backend().name, mosaic_ocr=mosaic_ocr,
+                      tiles=tiles[:2] if needs_tiling(image, tiles) else None)
+    key = cache.key(image, model_path, parameters)
+
+    results = cache.get(key)
+    if results is not None:
+        increment('analysis_cache_hits')
+        log.info("Found the results of the image in the analysis cache")
+        return results
+
+    increment('analysis_cache_misses')
+    results = analyze_image(image, model_path, mosaic_ocr=mosaic_ocr, ocr_workers=ocr_workers, tiles=tiles)
+    cache.put(key, results)
+    return results
@@ -1,4 +1,3 @@
-import json
 import os
 import sys
 import tkinter as tk
@@ -7,84 +6,14 @@ import logging as log
 
 import cv2
 
-from detection import detect_rectangles, detect_text, join_padded_rectangles, detect_buttons, detect_check_buttons, \
-    detect_radial_buttons, apply_ocr_on_rectangle, apply_ocr_on_rects
-from utils import rectangle
+from analysis import analyze_image, tiling, needs_tiling
+from results_io import write_results
 from visualize_results import visualize_results
 
 FORMAT = '[%(asctime)s] [%(levelname)s] : %(message)s'
 log.basicConfig(stream=sys.stdout, level=log.DEBUG, format=FORMAT)
 
 
-def analyze_image(image, model_path, debug=False):
-    net_results = detect_text(image, model_path, 0.1)
-
-    text_rects = join_padded_rectangles(net_results, (0.05, 0.05), image.shape[:2])
-
-    results = {}
-
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-    processed = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-
-    rectangles = detect_rectangles(processed, 50, 0.0)
-    if debug:
-        ocr_results = apply_ocr_on_rects(gray, text_rects, (0.1, 0.1))
-        debug_json = {
-            'rectangles': [rect.to_json() for rect in rectangles],
-            'texts': [{'text': result[1], 'rectangle': result[0].to_json()} for result in ocr_results]
-        }
-        with open('debug.json', 'w') as file:
-            file.write(json.dumps(debug_json, indent=2))
-
-    buttons = detect_buttons(image, rectangles, text_rects)
-    results['buttons'] = buttons
-    log.info("Completed detect buttons function")
-
-    check_buttons = detect_check_buttons(gray, rectangles, text_rects)
-    results['check_buttons'] = check_buttons
-    log.info("Completed detect check buttons function")
-
-    radial_buttons = detect_radial_buttons(gray, text_rects)
-    results['radial_buttons'] = radial_buttons
-    log.info("Completed detect radial buttons function")
-
-    processed_text_rects = []
-    for button in results['buttons']:
-        text_rect = rectangle.from_json(button['rectangle'])
-
-        processed_text_rects.append(text_rect)
-        text = apply_ocr_on_rectangle(image, text_rect, (0.0, 0.0))
-
-        button['text'] = text
-    log.info("Applying ocr on buttons finished")
-
-    for check_button in results['check_buttons']:
-        text_rect = check_button['associated_text_rect']
-
-        if text_rect:
-            text_rect = rectangle.from_json(text_rect)
-
-            processed_text_rects.append(text_rect)
-            text = apply_ocr_on_rectangle(image, text_rect, (0.1, 0.1))
-        else:
-            text = None
-
-        check_button['text'] = text
-    log.info("Applying ocr on check buttons finished")
-
-    for radial_button in radial_buttons:
-        text_rect = rectangle.from_json(radial_button['associated_text_rect'])
-
-        processed_text_rects.append(text_rect)
-        text = apply_ocr_on_rectangle(image, text_rect, (0.1, 0.1))
-
-        radial_button['text'] = text
-    log.info("Applying ocr on radial buttons finished")
-
-    return results
-
-
 class Application(tk.Frame):
     def __init__(self, master, image_path, output_path, model_path='./other/frozen_east_text_detection.pb'):
         tk.Frame.__init__(self, master, bg='#777777')
@@ -97,6 +26,9 @@ class Application(tk.Frame):
             self._image = tk.PhotoImage(file=image_path)
             self._input_image_canvas.create_image(5, 5, anchor=tk.NW, image=self._image)
 
+        # (path, pixels) of the last image analyzed, so visualizing its results doesn't read it again
+        self._analyzed_image = None
+
         # This frame will hold all of the widgets on the right side of the gui
         widget_frame = tk.Frame(master=self, bg='#555555')
         widget_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=1)
@@ -263,26 +195,30 @@ class Application(tk.Frame):
         try:
             image = cv2.imread(self._image_path_entry_var.get())
             height, width, _ = image.shape
-            if height > 1000 or width > 1000:
-                log.info("Resizing image (width or height > 1000)")
-                scale_percent = 500 / max(height, width)
-                print(scale_percent)
-                width = int(width * scale_percent)
-                height = int(height * scale_percent)
-                dim = (width, height)
-                image = cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
-            results = analyze_image(image, self._model_path_entry_var.get(), self._debug_check_button_var.get())
-
-            with open(self._results_path_entry_var.get(), 'w') as file:
-                file.write(json.dumps(results, indent=2))
+            # The analysis draws on the image, the visualization gets the pixels as they were read
+            self._analyzed_image = (self._image_path_entry_var.get(), image.copy())
+
+            # Shrinking a large image would lose the small text, so captures larger than 4K are analyzed in tiles
+            # instead. Anything smaller, like a 1080p screenshot, is analyzed whole.
+            tiles = tiling(4096, 128, 2)
+            if needs_tiling(image, tiles):
+                log.info(f"Analyzing image in tiles ({width}x{height} > {tiles.size})")
+            results = analyze_image(image, self._model_path_entry_var.get(), self._debug_check_button_var.get(),
+                                    tiles=tiles)
+
+            write_results(self._results_path_entry_var.get(), results, self._image_path_entry_var.get())
         except cv2.error:
             messagebox.showinfo("Run error", "Could not find pb model")
         except AttributeError:
             messagebox.showinfo("Run error", "Could not find image path")
 
     def gui_visualize_results(self):
-        result_image = visualize_results(self._image_path_entry_var.get(), self._results_path_entry_var.get(),
-                                         self._debug_check_button_var.get())
+        image_path = self._image_path_entry_var.get()
+        image = None
+        if self._analyzed_image and self._analyzed_image[0] == image_path:
+            image = self._analyzed_image[1]
+        result_image = visualize_results(image_path, self._results_path_entry_var.get(),
+                                         self._debug_check_button_var.get(), image=image)
 
         cv2.imshow("Result", result_image)
 
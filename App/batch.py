@@ -0,0 +1,171 @@
+import glob
+import logging as log
+import multiprocessing
+import os
+import threading
+import time
+
+import cv2
+
+from analysis import analyze_image, analyze_image_cached
+from cache import AnalysisCache
+from detection import get_text_detector
+from metrics import get_metrics
+from ocr import set_default_ocr_backend, configure_ocr_cache
+from results_io import ResultsReader, ResultsWriter, streaming_results_format
+from shared_images import SharedImageStore, with_shared_image
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+def collect_image_paths(sources):
+    # A source is a directory, a glob pattern or a text file with one image path per line
+    image_paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            image_paths.extend(sorted(os.path.join(source, name) for name in os.listdir(source)
+                                      if name.lower().endswith(IMAGE_EXTENSIONS)))
+        elif os.path.isfile(source) and not source.lower().endswith(IMAGE_EXTENSIONS):
+            with open(source, 'r') as file:
+                image_paths.extend(line.strip() for line in file if line.strip())
+        else:
+            image_paths.extend(sorted(glob.glob(source)))
+
+    # The same image given by several sources is analyzed once
+    return list(dict.fromkeys(image_paths))
+
+
+def read_analyzed_images(output_path):
+    # Only the offset index is read, an incomplete record left by an interrupted run doesn't count
+    if not os.path.exists(output_path):
+        return set()
+    return set(ResultsReader(output_path, streaming_results_format(output_path)).images())
+
+
+_worker_options = {}
+
+
+def _init_worker(model_path, options):
+    _worker_options.update(options, model_path=model_path)
+    # A forked worker starts with a copy of the metrics of the parent, only its own go back
+    get_metrics().reset()
+
+    set_default_ocr_backend(options['ocr_backend'])
+    configure_ocr_cache(directory=options['ocr_cache_dir'], max_bytes=options['ocr_cache_size'])
+    if options['cache_dir']:
+        _worker_options['cache'] = AnalysisCache(options['cache_dir'], options['cache_size'], options['cache_max_age'])
+
+    # Every worker loads the network once, before it gets its first image. A worker that can't load it reports the
+    # error for every image instead of dying, which would make the pool start a new worker over and over.
+    try:
+        get_text_detector(model_path)
+    except Exception as error:
+        _worker_options['init_error'] = f'Could not load {model_path}: {error}'
+
+
+def _analyze_path(image_path):
+    image_path, results, error = _analyze_path_results(image_path)
+    # The metrics of the worker since its last image go back with the results, the parent adds them up
+    return image_path, results, error, get_metrics().snapshot(reset=True)
+
+
+def _analyze_path_results(image_path):
+    options = _worker_options
+    if options.get('init_error'):
+        return image_path, None, options['init_error']
+
+    try:
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError('The image could not be read')
+        return image_path, _analyze_loaded_image(image), None
+    except Exception as error:
+        return image_path, None, f'{type(error).__name__}: {error}'
+
+
+def _analyze_loaded_image(image):
+    options = _worker_options
+    if options.get('cache'):
+        return analyze_image_cached(image, options['model_path'], options['cache'], mosaic_ocr=options['mosaic_ocr'],
+                                    ocr_workers=options['ocr_workers'], tiles=options['tiles'])
+    return analyze_image(image, options['model_path'], mosaic_ocr=options['mosaic_ocr'],
+                         ocr_workers=options['ocr_workers'], tiles=options['tiles'])
+
+
+def _analyze_shared_image(task):
+    index, descriptor = task
+    options = _worker_options
+    if options.get('init_error'):
+        results, error = None, options['init_error']
+    else:
+        try:
+            results, error = with_shared_image(descriptor, _analyze_loaded_image), None
+        except Exception as exception:
+            results, error = None, f'{type(exception).__name__}: {exception}'
+    return index, results, error, get_metrics().snapshot(reset=True)
+
+
+def analyze_batch(image_paths, output_path, model_path, processes=None, **options):
+    analyzed = read_analyzed_images(output_path)
+    pending = [image_path for image_path in image_paths if image_path not in analyzed]
+    log.info(f'{len(image_paths)} images, {len(image_paths) - len(pending)} already in {output_path}, '
+             f'{len(pending)} to analyze')
+    if not pending:
+        return 0
+
+    failed = 0
+    start = time.perf_counter()
+
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(model_path, options)) as pool, \
+            ResultsWriter(output_path) as writer:
+        # Results are written as soon as they arrive, one record per image, so an interrupted run can resume
+        for done, (image_path, results, error, metrics) in enumerate(pool.imap_unordered(_analyze_path, pending), 1):
+            get_metrics().merge(metrics)
+            if error:
+                failed += 1
+                get_metrics().increment('batch_failures')
+                log.error(f'Could not analyze {image_path}: {error}')
+            else:
+                writer.write(image_path, results)
+
+            elapsed = time.perf_counter() - start
+            log.info(f'[{done}/{len(pending)}] {image_path} ({done / elapsed:.2f} images/s)')
+
+    return failed
+
+
+def analyze_image_arrays(images, model_path, processes=None, max_in_flight=None, **options):
+    # Analyzes images that are already decoded, like the frames of a capture. Every image is copied once into shared
+    # memory and the workers get a descriptor of it instead of a pickled copy. Yields (results, error) in the order of
+    # the images, the options are the ones of analyze_batch.
+    # The pool reads the tasks as fast as it can, at most max_in_flight images (twice the workers by default) are in
+    # shared memory at the same time so a long capture can't fill it.
+    max_in_flight = max_in_flight or 2 * (processes or os.cpu_count() or 1)
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    stopped = threading.Event()
+
+    with SharedImageStore() as store, \
+            multiprocessing.Pool(processes, initializer=_init_worker, initargs=(model_path, options)) as pool:
+        descriptors = {}
+
+        def tasks():
+            for index, image in enumerate(images):
+                # Runs in the task thread of the pool, which must not wait forever once the results are abandoned
+                while not in_flight.acquire(timeout=0.1):
+                    if stopped.is_set():
+                        return
+                descriptors[index] = store.put(image)
+                yield index, descriptors[index]
+
+        try:
+            for index, results, error, metrics in pool.imap(_analyze_shared_image, tasks()):
+                # The worker is done with the image, its buffer goes away with the last reference
+                store.release(descriptors.pop(index))
+                in_flight.release()
+                get_metrics().merge(metrics)
+                if error:
+                    get_metrics().increment('batch_failures')
+                    log.error(f'Could not analyze image {index}: {error}')
+                yield results, error
+        finally:
+            stopped.set()
@@ -0,0 +1,148 @@
+import argparse
+import glob
+import json
+import logging as log
+import os
+import platform
+import time
+
+import cv2
+import numpy as np
+
+from analysis import analyze_image
+from detection import get_text_detector
+from metrics import get_metrics
+from ocr import OCR_BACKENDS, DEFAULT_OCR_BACKEND, set_default_ocr_backend, configure_ocr_cache
+
+APP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+END_TO_END = 'end_to_end'
+
+
+def run_suite(images, model_path, stage_workers, ocr_workers):
+    # One run analyzes every image once. Each stage gets the total of its durations over the run.
+    get_metrics().reset()
+
+    # The analysis draws the buttons it finds into its input, every run starts from the images as they were read. The
+    # copies are made before the clock starts.
+    images = [image.copy() for image in images]
+
+    start = time.perf_counter()
+    for image in images:
+        analyze_image(image, model_path, ocr_workers=ocr_workers, stage_workers=stage_workers)
+    end_to_end = time.perf_counter() - start
+
+    durations = {name: histogram['sum'] for name, histogram in get_metrics().snapshot(reset=True)['durations'].items()}
+    durations[END_TO_END] = end_to_end
+    return durations
+
+
+def summarize(runs):
+    summary = {}
+    for name in sorted(set(name for run in runs for name in run)):
+        samples = [run.get(name, 0.0) for run in runs]
+        summary[name] = {'median': float(np.median(samples)), 'p95': float(np.percentile(samples, 95))}
+    return summary
+
+
+def find_regressions(summary, baseline, threshold, min_duration):
+    # A stage regresses when its median grows by more than the threshold. Stages faster than min_duration are only
+    # noise and never count.
+    regressions = []
+    for name, stats in baseline['stages'].items():
+        current = summary.get(name)
+        if current is None or max(current['median'], stats['median']) < min_duration:
+            continue
+        if current['median'] > stats['median'] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+
+def print_report(summary, baseline):
+    print(f'{"stage":<36}{"median (s)":>12}{"p95 (s)":>12}{"baseline (s)":>14}{"change":>9}')
+    for name, stats in summary.items():
+        line = f'{name:<36}{stats["median"]:>12.4f}{stats["p95"]:>12.4f}'
+        baseline_stats = baseline['stages'].get(name) if baseline else None
+        if baseline_stats:
+            change = (stats['median'] / baseline_stats['median'] - 1) * 100 if baseline_stats['median'] else 0.0
+            line += f'{baseline_stats["median"]:>14.4f}{change:>+8.1f}%'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every stage of the analysis over the test images')
+    parser.add_argument('--model_path', '-m', help='Path to the pb file for the neural network',
+                        default=os.path.join(APP_DIRECTORY, 'other', 'frozen_east_text_detection.pb'))
+    parser.add_argument('--images', nargs='+', help='Images to analyze, the png test images by default')
+    parser.add_argument('--runs', type=int, default=10, help='Number of timed runs over all the images')
+    parser.add_argument('--warmup', type=int, default=1, help='Number of runs before the timed ones')
+    parser.add_argument('--stage_workers', type=int, default=4, help='Number of analysis stages run at the same time')
+    parser.add_argument('--ocr_workers', type=int, default=1, metavar='N',
+                        help='Number of regions of an image recognized at the same time')
+    parser.add_argument('--ocr_backend', choices=sorted(OCR_BACKENDS), default=DEFAULT_OCR_BACKEND,
+                        help='OCR engine to use')
+    parser.add_argument('--baseline', default=os.path.join(APP_DIRECTORY, 'benchmark_baseline.json'),
+                        help='Baseline to compare against, written by the first run when it does not exist')
+    parser.add_argument('--update_baseline', action='store_true', help='Replace the baseline with this run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Relative growth of a stage median over the baseline that counts as a regression')
+    parser.add_argument('--min_duration', type=float, default=0.005,
+                        help='Stages faster than this many seconds are not checked for regressions')
+    parser.add_argument('--output', '-o', help='Also write the summary of the runs to this json file')
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.WARNING)
+
+    image_paths = args.images or sorted(glob.glob(os.path.join(APP_DIRECTORY, 'test_images', '*.png')))
+    images = [cv2.imread(image_path) for image_path in image_paths]
+    if not images or any(image is None for image in images):
+        raise SystemExit('The images could not be read')
+
+    # Every run must do all the work, nothing may come from the OCR results of the previous runs
+    set_default_ocr_backend(args.ocr_backend)
+    configure_ocr_cache(enabled=False)
+    get_text_detector(args.model_path)
+
+    for _ in range(args.warmup):
+        run_suite(images, args.model_path, args.stage_workers, args.ocr_workers)
+
+    runs = []
+    for run in range(args.runs):
+        runs.append(run_suite(images, args.model_path, args.stage_workers, args.ocr_workers))
+        print(f'Run {run + 1}/{args.runs} took {runs[-1][END_TO_END]:.3f} seconds')
+
+    summary = summarize(runs)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+
+    print_report(summary, baseline)
+
+    document = {
+        'images': [os.path.relpath(image_path, APP_DIRECTORY) for image_path in image_paths],
+        'runs': args.runs,
+        'platform': platform.platform(),
+        'opencv': cv2.__version__,
+        'stages': summary,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(json.dumps(document, indent=2))
+
+    if baseline is None:
+        with open(args.baseline, 'w') as file:
+            file.write(json.dumps(document, indent=2))
+        print(f'Baseline written to {args.baseline}')
+        return
+
+    regressions = find_regressions(summary, baseline, args.threshold, args.min_duration)
+    if regressions:
+        raise SystemExit(f'{len(regressions)} stages regressed by more than {args.threshold:.0%}: '
+                         f'{", ".join(regressions)}')
+    print(f'No stage regressed by more than {args.threshold:.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+class DiskCache:
+    def __init__(self, directory, max_bytes, max_age=None):
+        # Every value is a json file named after its key. Reading a value touches the file, so the modification time
+        # is the last use and the oldest files are the least recently used ones.
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._size = None
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self._directory, key[:2], key + '.json')
+
+    def _files(self):
+        for root, _, names in os.walk(self._directory):
+            for name in names:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if self._max_age is not None and time.time() - os.path.getmtime(path) > self._max_age:
+                self._remove(path)
+                return None
+
+            with open(path, 'r') as file:
+                value = json.load(file)
+            os.utime(path)
+            return value
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Written next to the final file and renamed, so a reader never sees half of a value
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(value, file)
+        size = os.path.getsize(temp_path)
+
+        with self._lock:
+            # A value written again replaces the file of the old one, only the difference adds to the size
+            try:
+                replaced_size = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced_size = 0
+            os.replace(temp_path, path)
+
+            if self._size is None:
+                self._size = sum(file_size for _, file_size, _ in self._files())
+            else:
+                self._size += size - replaced_size
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        files = sorted(self._files(), key=lambda file: file[2])
+        self._size = sum(size for _, size, _ in files)
+
+        now = time.time()
+        for path, size, mtime in files:
+            expired = self._max_age is not None and now - mtime > self._max_age
+            # Evict down to 90% of the limit, so the next few writes don't scan the directory again
+            if not expired and self._size <= 0.9 * self._max_bytes:
+                continue
+            self._remove(path)
+            self._size -= size
+
+    def clear(self):
+        with self._lock:
+            for path, _, _ in list(self._files()):
+                self._remove(path)
+            self._size = 0
+
+
+# Bump when the detection code changes in a way that changes the results of the same image and parameters.
+# 2: circle coordinates are plain ints, so radio buttons under NumPy 2 match the text next to them.
+# 3: the checked state of a toggle comes from its white pixels in the Otsu threshold of the whole image.
+ANALYSIS_VERSION = 3
+
+
+class AnalysisCache:
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, max_age=30 * 24 * 60 * 60):
+        self._disk = DiskCache(directory, max_bytes, max_age)
+        self._model_digests = {}
+        self._lock = threading.Lock()
+
+    def _model_digest(self, model_path):
+        # Hashing the model takes longer than a cache hit, so its digest is cached too, for as long as the file is
+        # unchanged
+        stat = os.stat(model_path)
+        signature = f'model|{os.path.abspath(model_path)}|{stat.st_size}|{stat.st_mtime}'
+        signature_key = hashlib.sha1(signature.encode()).hexdigest()
+
+        with self._lock:
+            digest = self._model_digests.get(signature_key) or self._disk.get(signature_key)
+        if digest is None:
+            sha1 = hashlib.sha1()
+            with open(model_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                    sha1.update(chunk)
+            digest = sha1.hexdigest()
+            self._disk.put(signature_key, digest)
+        with self._lock:
+            self._model_digests[signature_key] = digest
+        return digest
+
+    def key(self, image, model_path, parameters):
+        digest = hashlib.sha1(f'{ANALYSIS_VERSION}|{image.shape}|{image.dtype}|'.encode())
+        digest.update(self._model_digest(model_path).encode())
+        digest.update(json.dumps(parameters, sort_keys=True).encode())
+        digest.update(image.data if image.flags.c_contiguous else image.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        return self._disk.get(key)
+
+    def put(self, key, results):
+        self._disk.put(key, results)
@@ -1,122 +1,266 @@
-import itertools
+import functools
+import logging
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import imutils
 import numpy as np
-import pytesseract
 from imutils import object_detection
 
-from utils import timer, join, overlap, circle, rectangle, point, is_rect_inside_rect, is_inside_circle
+from metrics import increment
+from ocr import ocr_mosaic, ocr_rois
+from utils import timer, circle, rectangle, point, merge_overlapping_rectangles, GridIndex, RectArray, overlap_ratios, \
+    are_rects_inside_rects, are_points_inside_circles, rect_sums, circle_sums, join, overlap, DisjointSet
+
+
+class ImageContext:
+    # Planes a crop of the image takes from the same plane of the whole image. Adaptive thresholding looks at the
+    # neighbours of a pixel and Otsu at the whole histogram, so computing them again on the crop would differ.
+    CROPPED_PLANES = ('gray', 'adaptive_threshold', 'otsu')
+
+    def __init__(self, image, parent=None, roi=None):
+        # The planes derived from the image are computed the first time a detector asks for them and kept for the rest
+        # of the analysis. Stages running at the same time wait for the one computing a plane instead of repeating it.
+        self.image = image
+        self._parent = parent
+        self._roi = roi
+        self._planes = {}
+        self._plane_locks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    def writable_image(self):
+        # The image to draw on. A read-only image, like a view of a shared buffer, is copied the first time and the
+        # copy replaces it for the rest of the analysis.
+        with self._lock:
+            if not self.image.flags.writeable:
+                self.image = self.image.copy()
+            return self.image
+
+    def crop(self, rect):
+        x, y, w, h = rect
+        roi = (slice(y, y + h), slice(x, x + w))
+        return ImageContext(self.image[roi], self, roi)
+
+    def _plane(self, name, *args):
+        key = (name,) + args
+        with self._lock:
+            if key in self._planes:
+                return self._planes[key]
+            plane_lock = self._plane_locks.setdefault(key, threading.Lock())
+
+        with plane_lock:
+            with self._lock:
+                if key in self._planes:
+                    return self._planes[key]
+
+            if self._parent is not None and name in self.CROPPED_PLANES:
+                plane = self._parent._plane(name, *args)[self._roi]
+            else:
+                plane = getattr(self, f'_compute_{name}')(*args)
+
+            with self._lock:
+                self._planes[key] = plane
+        return plane
+
+    def gray(self):
+        return self._plane('gray')
+
+    def adaptive_threshold(self, block_size=11, c=2):
+        return self._plane('adaptive_threshold', block_size, c)
+
+    def otsu(self):
+        return self._plane('otsu')
+
+    def integral(self, rect=None):
+        # Summed-area table of the Otsu plane counting white pixels as 1, over rect or the whole image, and one pixel
+        # larger than it on each axis
+        return self._plane('integral', None if rect is None else tuple(rect))
+
+    def east_input(self):
+        # The image resized for the text detection network and the scale back to the image
+        return self._plane('east_input')
+
+    def contours(self, block_size=11, c=2, approximation_type=cv2.CHAIN_APPROX_SIMPLE):
+        return self._plane('contours', block_size, c, approximation_type)
+
+    def _compute_gray(self):
+        # Detectors used to take the gray plane itself, a context of a gray plane uses it as it is
+        if self.image.ndim == 2:
+            return self.image
+        with timer('Convert to gray'):
+            return cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
 
+    def _compute_adaptive_threshold(self, block_size, c):
+        with timer('Adaptive threshold'):
+            return cv2.adaptiveThreshold(self.gray(), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                         block_size, c)
 
-def detect_circles(gray_image, min_radius, max_radius, param1, param2):
-    circles = cv2.HoughCircles(gray_image, cv2.HOUGH_GRADIENT, 1, min_radius, param1=param1, param2=param2,
+    def _compute_otsu(self):
+        with timer('Otsu threshold'):
+            return cv2.threshold(self.gray(), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+
+    def _compute_integral(self, rect):
+        otsu = self.otsu()
+        if rect is not None:
+            x, y, w, h = rect
+            otsu = otsu[y:y + h, x:x + w]
+        with timer('Integral image'):
+            return cv2.integral(cv2.threshold(otsu, 0, 1, cv2.THRESH_BINARY)[1])
+
+    def _compute_east_input(self):
+        return resize_image_for_net(self.image, self.image.shape[:2])
+
+    def _compute_contours(self, block_size, c, approximation_type):
+        with timer('Find contours'):
+            contours, _ = cv2.findContours(self.adaptive_threshold(block_size, c), cv2.RETR_LIST, approximation_type)
+        return contours
+
+
+def image_context(image):
+    # The detectors take an ImageContext, a plain image gets a context of its own
+    return image if isinstance(image, ImageContext) else ImageContext(image)
+
+
+def detect_circles(context, min_radius, max_radius, param1, param2):
+    circles = cv2.HoughCircles(image_context(context).gray(), cv2.HOUGH_GRADIENT, 1, min_radius, param1=param1, param2=param2,
                                minRadius=min_radius, maxRadius=max_radius)
     results = []
     if circles is not None:
         circles = np.uint16(np.around(circles))
         for i in circles[0, :]:
-            circ = circle(point(i[0], i[1]), i[2])
+            # Plain ints, so distances to the circle can't wrap around like uint16 arithmetic does
+            circ = circle(point(int(i[0]), int(i[1])), int(i[2]))
             results.append(circ)
     return results
 
 
-def detect_rectangles(image, area_thresh, coef, approximation_type=cv2.CHAIN_APPROX_SIMPLE):
-    contours, _ = cv2.findContours(image, cv2.RETR_LIST, approximation_type)
+def detect_rectangles(context, area_thresh, coef, approximation_type=cv2.CHAIN_APPROX_SIMPLE, block_size=11, c=2):
+    contours = image_context(context).contours(block_size, c, approximation_type)
+
+    with timer('Approximate contours'):
+        # The approximated polygon lies inside the bounding box of the contour, so a contour with a small bounding
+        # box can never pass the area check. This throws away the glyph contours before approxPolyDP.
+        candidates = [contour for contour in contours if _bounding_box_area(contour) > area_thresh]
+
+        quads = [approx for approx in (cv2.approxPolyDP(contour, coef * cv2.arcLength(contour, True), True)
+                                       for contour in candidates) if len(approx) == 4]
+
+    with timer('Validate quads'):
+        results = set(rectangle(*rect) for rect in validate_quads(quads, area_thresh))
+
+    logging.info(f'Rectangles: {len(contours)} contours, {len(candidates)} after area pre-filter, '
+                 f'{len(quads)} quads, {len(results)} rectangles')
+    increment('contours', len(contours))
+    increment('contours_after_area_prefilter', len(candidates))
+    increment('quad_candidates', len(quads))
+    increment('rectangles', len(results))
+
+    return results
+
+
+def detect_rectangles_tiled(context, area_thresh, coef, tile_size=1024, tile_overlap=128, workers=1,
+                            approximation_type=cv2.CHAIN_APPROX_SIMPLE, block_size=11, c=2):
+    context = image_context(context)
+    dimensions = context.shape[:2]
 
-    results = set()
-    for contour in contours:
-        approx = cv2.approxPolyDP(contour, coef * cv2.arcLength(contour, True), True)
+    # The tiles share the threshold of the whole image, only the contours are found tile by tile
+    context.adaptive_threshold(block_size, c)
 
-        if len(approx) != 4:
-            continue
+    def detect_tile(tile):
+        return [(rectangle(x + tile.x, y + tile.y, w, h), tile)
+                for x, y, w, h in detect_rectangles(context.crop(tile), area_thresh, coef, approximation_type,
+                                                    block_size, c)]
 
-        # (x11, y11)        (x22, y22)
-        #   o-----------------o
-        #   |                 |
-        #   |                 |
-        #   o-----------------o
-        # (x12, y12)       (x21, y21)
+    # Widgets are often wider than the overlap of two tiles but rarely taller, so the tiles are horizontal strips as
+    # wide as the image. A rectangle inside the overlap of two strips is found by both, the set keeps one. A container
+    # taller than the overlap is cut in every strip, its pieces are joined.
+    with timer('Tiled rectangle detection'):
+        tiles = split_into_tiles(dimensions, (tile_size, dimensions[1]), tile_overlap)
+        whole, pieces = split_cut_pieces([found for tile_found in _map_tiles(detect_tile, tiles, workers)
+                                          for found in tile_found], dimensions)
+        return set(whole) | set(join_cut_pieces(pieces, dimensions))
 
-        ((x11, y11),), ((x12, y12),), ((x21, y21),), ((x22, y22),) = approx
 
-        # Check that the sides are equal
-        w1 = x22 - x11
-        w2 = x21 - x12
-        h1 = y12 - y11
-        h2 = y21 - y22
+def _bounding_box_area(contour):
+    _, _, w, h = cv2.boundingRect(contour)
+    return w * h
 
-        diff = abs(w1 - w2)
-        if diff > 0.1 * w1 or diff > 0.1 * w2:
-            continue
 
-        diff = abs(h1 - h2)
-        if diff > 0.1 * h1 or diff > 0.1 * h2:
-            continue
+def validate_quads(quads, area_thresh):
+    if not quads:
+        return []
 
-        # Check that the sides are HORIZONTAL or PARALLEL
-        thresh_x = (x22 - x11) * 0.1
-        thresh_y = (y12 - y11) * 0.1
-        if any([
-            abs(x11 - x12) > thresh_x,
-            abs(x22 - x21) > thresh_x,
-            abs(y11 - y22) > thresh_y,
-            abs(y12 - y21) > thresh_y
-        ]):
-            continue
+    # (x11, y11)        (x22, y22)
+    #   o-----------------o
+    #   |                 |
+    #   |                 |
+    #   o-----------------o
+    # (x12, y12)       (x21, y21)
 
-        if cv2.contourArea(approx) > area_thresh:
-            x, y, w, h = cv2.boundingRect(approx)
-            results.add(rectangle(x, y, w, h))
+    points = np.array(quads).reshape(-1, 4, 2)
+    (x11, x12, x21, x22), (y11, y12, y21, y22) = points[:, :, 0].T, points[:, :, 1].T
 
-    #delete duplicates from results
-    to_remove = set()
-    for rect1, rect2 in itertools.combinations(results, 2):
-        if rect1 not in to_remove and \
-                rect1.x == rect2.x and rect1.y == rect2.y and rect1.w == rect2.w and rect1.h == rect2.h:
-            to_remove.add(rect1)
+    # Check that the sides are equal
+    w1 = x22 - x11
+    w2 = x21 - x12
+    h1 = y12 - y11
+    h2 = y21 - y22
 
-    results = results.difference(to_remove)
+    diff = np.abs(w1 - w2)
+    valid = (diff <= 0.1 * w1) & (diff <= 0.1 * w2)
 
-    return results
+    diff = np.abs(h1 - h2)
+    valid &= (diff <= 0.1 * h1) & (diff <= 0.1 * h2)
+
+    # Check that the sides are HORIZONTAL or PARALLEL
+    thresh_x = (x22 - x11) * 0.1
+    thresh_y = (y12 - y11) * 0.1
+    valid &= (np.abs(x11 - x12) <= thresh_x) & (np.abs(x22 - x21) <= thresh_x) & \
+             (np.abs(y11 - y22) <= thresh_y) & (np.abs(y12 - y21) <= thresh_y)
+
+    # Shoelace formula, the same as cv2.contourArea
+    x = points[:, :, 0].astype(np.int64)
+    y = points[:, :, 1].astype(np.int64)
+    area = np.abs(np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1)) * 0.5
+    valid &= area > area_thresh
+
+    # Same as cv2.boundingRect, which counts both the first and the last pixel
+    points = points[valid]
+    start = points.min(axis=1)
+    size = points.max(axis=1) - start + 1
+
+    return np.hstack((start, size)).tolist()
 
 
 def decode_predictions(scores, geometry, min_confidence):
-    # grab the number of rows and columns from the scores volume, then
-    # initialize our set of bounding box rectangles and corresponding
-    # confidence scores
-    (numRows, numCols) = scores.shape[2:4]
-    rects = []
-    confidences = []
-
-    for y in range(0, numRows):
-        scores_data = scores[0, 0, y]
-        x_data0 = geometry[0, 0, y]
-        x_data1 = geometry[0, 1, y]
-        x_data2 = geometry[0, 2, y]
-        x_data3 = geometry[0, 3, y]
-        angles_data = geometry[0, 4, y]
-
-        for x in range(0, numCols):
-            if scores_data[x] < min_confidence:
-                continue
-
-            (offsetX, offsetY) = (x * 4.0, y * 4.0)
-
-            angle = angles_data[x]
-            cos = np.cos(angle)
-            sin = np.sin(angle)
-
-            h = x_data0[x] + x_data2[x]
-            w = x_data1[x] + x_data3[x]
-
-            end_x = int(offsetX + (cos * x_data1[x]) + (sin * x_data2[x]))
-            end_y = int(offsetY - (sin * x_data1[x]) + (cos * x_data2[x]))
-            start_x = int(end_x - w)
-            start_y = int(end_y - h)
-
-            rects.append((start_x, start_y, end_x, end_y))
-            confidences.append(scores_data[x])
+    # Only the cells of the score map that pass the confidence threshold produce a box, in row-major order
+    ys, xs = np.nonzero(scores[0, 0] >= min_confidence)
+
+    confidences = scores[0, 0, ys, xs]
+    x_data0, x_data1, x_data2, x_data3, angles = geometry[0, :, ys, xs].T
+
+    offset_x = xs * 4.0
+    offset_y = ys * 4.0
+
+    cos = np.cos(angles)
+    sin = np.sin(angles)
+
+    h = x_data0 + x_data2
+    w = x_data1 + x_data3
+
+    end_x = np.trunc(offset_x + (cos * x_data1) + (sin * x_data2)).astype(int)
+    end_y = np.trunc(offset_y - (sin * x_data1) + (cos * x_data2)).astype(int)
+    start_x = np.trunc(end_x - w).astype(int)
+    start_y = np.trunc(end_y - h).astype(int)
+
+    rects = np.stack((start_x, start_y, end_x, end_y), axis=1)
 
     return rects, confidences
 
@@ -157,69 +301,250 @@ def apply_padding(boxes, join_padding, original_dimensions):
 
 
 def join_overlapping_rectangles(results):
-    results = sorted(results, key=lambda r: r.x)
-
-    joined = set()
-    processed = set()
-
-    while True:
-        found_overlap = False
-        for rect1, rect2 in itertools.combinations(results, 2):
-            if rect1 not in processed and rect2 not in processed:
-                if overlap(rect1, rect2):
-                    joined.add(join(rect1, rect2))
-                    processed.add(rect1)
-                    processed.add(rect2)
-                    found_overlap = True
-
-        for rect in results:
-            if rect not in processed:
-                joined.add(rect)
-
-        if not found_overlap:
-            break
-        else:
-            results = joined
-            joined = set()
-            processed = set()
+    return merge_overlapping_rectangles(results)
+
+
+EAST_OUTPUT_LAYERS = ['feature_fusion/Conv_7/Sigmoid', 'feature_fusion/concat_3']
+
+
+class TextDetector:
+    def __init__(self, model_path):
+        self.model_path = model_path
+
+        with timer('Read network'):
+            self._net = cv2.dnn.readNet(model_path)
+
+        # The network is not safe to use from several threads at the same time
+        self._lock = threading.Lock()
+
+        with timer('Warm up network'):
+            self.forward(np.zeros((1, 3, 32, 32), dtype=np.float32))
+
+    def forward(self, blob):
+        with self._lock:
+            self._net.setInput(blob)
+            return self._net.forward(EAST_OUTPUT_LAYERS)
+
+    def detect(self, context, min_confidence):
+        image, rel_dim = image_context(context).east_input()
+        new_dimensions = image.shape[:2]
+
+        boxes = apply_east_text_detection(image, min_confidence, self, new_dimensions)
+
+        return rescale_text_rects(boxes, rel_dim)
+
+    def detect_batch(self, contexts, min_confidence, batch_size=8, pad=False):
+        resized = [image_context(context).east_input() for context in contexts]
+
+        # Images sharing the network input size go through one forward pass. With padding every image of a chunk
+        # is padded at the bottom and right to the largest size, so any mix of sizes can be batched.
+        groups = {}
+        for index, (image, _) in enumerate(resized):
+            key = None if pad else image.shape[:2]
+            groups.setdefault(key, []).append(index)
+
+        results = [None] * len(contexts)
+        for indices in groups.values():
+            for chunk_start in range(0, len(indices), batch_size):
+                chunk = indices[chunk_start:chunk_start + batch_size]
+                boxes = apply_east_text_detection_batch([resized[index][0] for index in chunk], min_confidence, self)
+
+                for index, image_boxes in zip(chunk, boxes):
+                    results[index] = rescale_text_rects(image_boxes, resized[index][1])
 
-    return joined
+        return results
 
 
-def detect_text(image, model_path, min_confidence):
-    original_dimensions = image.shape[:2]
-    with timer('Read network'):
-        net = cv2.dnn.readNet(model_path)
+_text_detectors = {}
+_text_detectors_lock = threading.Lock()
+
+
+def get_text_detector(model_path):
+    # Loading the EAST graph is slower than running it, so every caller in the process shares one session per model
+    key = os.path.abspath(model_path)
+    with _text_detectors_lock:
+        detector = _text_detectors.get(key)
+        if detector is None:
+            detector = TextDetector(model_path)
+            _text_detectors[key] = detector
+    return detector
+
+
+def detect_text(context, model_path, min_confidence):
+    return get_text_detector(model_path).detect(context, min_confidence)
+
+
+def detect_text_batch(contexts, model_path, min_confidence, batch_size=8, pad=False):
+    return get_text_detector(model_path).detect_batch(contexts, min_confidence, batch_size, pad)
+
+
+def split_into_tiles(dimensions, tile_size, tile_overlap):
+    height, width = dimensions
+    tile_height, tile_width = tile_size
+    if not 0 <= tile_overlap < min(tile_size):
+        raise ValueError(f'The tile overlap {tile_overlap} must be at least 0 and less than the tile size '
+                         f'{min(tile_size)}')
+
+    def spread(length, size):
+        # As few tiles as cover the length, shrunk to the same size and spread evenly so neighbouring tiles overlap by
+        # about tile_overlap. Tiles of the full size would overlap by most of a tile when the length is a bit more
+        # than one tile.
+        if length <= size:
+            return [0], length
+        count = math.ceil((length - tile_overlap) / (size - tile_overlap))
+        size = math.ceil((length + (count - 1) * tile_overlap) / count)
+        step = (length - size) / (count - 1)
+        return [round(index * step) for index in range(count)], size
+
+    (ys, tile_height), (xs, tile_width) = spread(height, tile_height), spread(width, tile_width)
+    return [rectangle(x, y, tile_width, tile_height) for y in ys for x in xs]
+
+
+def is_cut_by_tile(rect, tile, dimensions, border=1):
+    # A rectangle touching a side of its tile that is not a side of the image may continue in the next tile.
+    # findContours ignores the outermost pixel of an image, hence the one pixel border.
+    height, width = dimensions
+    return any([
+        tile.x > 0 and rect.x <= tile.x + border,
+        tile.y > 0 and rect.y <= tile.y + border,
+        tile.x + tile.w < width and rect.x + rect.w >= tile.x + tile.w - border,
+        tile.y + tile.h < height and rect.y + rect.h >= tile.y + tile.h - border
+    ])
+
+
+def split_cut_pieces(found, dimensions, border=1):
+    # found are (detection, tile) pairs, split into the detections whole in their tile and the (piece, tile) pairs of
+    # the ones cut by it
+    whole = [rect for rect, tile in found if not is_cut_by_tile(rect, tile, dimensions, border)]
+    pieces = [(rect, tile) for rect, tile in found if is_cut_by_tile(rect, tile, dimensions, border)]
+    return whole, pieces
+
+
+def _continues(piece1, tile1, piece2, tile2, tolerance):
+    # Two pieces of neighbouring tiles continue each other across the seam when they overlap and have the same extent
+    # along it
+    if tile1 == tile2 or overlap(piece1, piece2) == 0:
+        return False
+    if tile1.x == tile2.x:
+        start1, end1, start2, end2 = piece1.x, piece1.x + piece1.w, piece2.x, piece2.x + piece2.w
+    elif tile1.y == tile2.y:
+        start1, end1, start2, end2 = piece1.y, piece1.y + piece1.h, piece2.y, piece2.y + piece2.h
+    else:
+        return False
+    allowed = tolerance * min(end1 - start1, end2 - start2) + 1
+    return abs(start1 - start2) <= allowed and abs(end1 - end2) <= allowed
+
+
+def join_cut_pieces(pieces, dimensions, tolerance=0.0, border=1):
+    # A detection larger than the overlap of two tiles is cut in every tile that has a part of it. The pieces that
+    # continue each other are joined, the joined box is kept when it is whole in the tiles of its pieces. A piece of a
+    # detection found whole in another tile has no continuation there, so it is dropped like the pieces between two
+    # long lines that only look like a rectangle inside one tile. tolerance is the difference allowed between the
+    # extents of two pieces along their seam, relative to the extent.
+    rects = [piece for piece, _ in pieces]
+
+    disjoint_set = DisjointSet(len(pieces))
+    first, second = GridIndex(rects).query_pairs(_rect_boxes(rects))
+    for i, j in zip(first.tolist(), second.tolist()):
+        if i < j and _continues(*pieces[i], *pieces[j], tolerance):
+            disjoint_set.union(i, j)
+
+    results = []
+    for group in disjoint_set.groups():
+        joined = functools.reduce(join, [pieces[i][0] for i in group])
+        if not is_cut_by_tile(joined, functools.reduce(join, [pieces[i][1] for i in group]), dimensions, border):
+            results.append(joined)
+    return results
 
-    image, rel_dim = resize_image_for_net(image, original_dimensions)
-    new_dimensions = image.shape[:2]
 
-    boxes = apply_east_text_detection(image, min_confidence, net, new_dimensions)
+def _map_tiles(function, tiles, workers):
+    if workers <= 1:
+        return [function(tile) for tile in tiles]
 
-    resize_results = rescale_text_rects(boxes, rel_dim)
+    # Only the tiles being processed are in memory at the same time
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, tiles))
 
-    return resize_results
+
+def detect_text_tiled(context, model_path, min_confidence, tile_size=1024, tile_overlap=128, workers=1):
+    context = image_context(context)
+    detector = get_text_detector(model_path)
+    dimensions = context.shape[:2]
+
+    def detect_tile(tile):
+        return [(rectangle(x + tile.x, y + tile.y, w, h), tile)
+                for x, y, w, h in detector.detect(context.crop(tile), min_confidence)]
+
+    # The network draws the box of a word a bit differently in each tile, the pieces of a long line of text cut in
+    # every tile can differ by a fifth of their height
+    with timer('Tiled text detection'):
+        tiles = split_into_tiles(dimensions, (tile_size, tile_size), tile_overlap)
+        whole, pieces = split_cut_pieces([found for tile_found in _map_tiles(detect_tile, tiles, workers)
+                                          for found in tile_found], dimensions)
+        boxes = whole + join_cut_pieces(pieces, dimensions, 0.2)
+
+    if not boxes:
+        return []
+
+    # The same word is found whole in every tile that contains it, keep one box of each
+    corners = np.array([(x, y, x + w, y + h) for x, y, w, h in boxes])
+    boxes = imutils.object_detection.non_max_suppression(corners)
+    return [rectangle(start_x, start_y, end_x - start_x, end_y - start_y)
+            for start_x, start_y, end_x, end_y in boxes.tolist()]
 
 
 def join_padded_rectangles(rectangles, padding, original_dimensions):
     results = apply_padding(rectangles, padding, original_dimensions)
     results = join_overlapping_rectangles(results)
+    increment('text_rects_before_merge', len(rectangles))
+    increment('text_rects_merged', len(results))
     return results
 
 
-def apply_east_text_detection(image, min_confidence, net, new_dimensions):
+EAST_MEAN = (123.68, 116.78, 103.94)
+
+
+def apply_east_text_detection(image, min_confidence, detector, new_dimensions):
     new_height, new_width = new_dimensions
 
     with timer('Blob from image'):
-        blob = cv2.dnn.blobFromImage(image, 1.0, (new_width, new_height), (123.68, 116.78, 103.94), True, False)
-    output_layers = ['feature_fusion/Conv_7/Sigmoid', 'feature_fusion/concat_3']
-    net.setInput(blob)
+        blob = cv2.dnn.blobFromImage(image, 1.0, (new_width, new_height), EAST_MEAN, True, False)
     with timer('Forward layers to net'):
-        scores, geometry = net.forward(output_layers)
+        scores, geometry = detector.forward(blob)
+
+    return decode_text_boxes(scores, geometry, min_confidence)
+
+
+def apply_east_text_detection_batch(images, min_confidence, detector):
+    new_height = max(image.shape[0] for image in images)
+    new_width = max(image.shape[1] for image in images)
+
+    # Pad with the network mean (images are BGR, the mean is RGB) so the padding is zero after normalization
+    padding_color = EAST_MEAN[::-1]
+    padded = [cv2.copyMakeBorder(image, 0, new_height - image.shape[0], 0, new_width - image.shape[1],
+                                 cv2.BORDER_CONSTANT, value=padding_color) for image in images]
+
+    with timer(f'Blob from {len(images)} images', 'blob_from_images'):
+        blob = cv2.dnn.blobFromImages(padded, 1.0, (new_width, new_height), EAST_MEAN, True, False)
+    with timer(f'Forward layers to net for {len(images)} images', 'forward_layers_to_net_batch'):
+        scores, geometry = detector.forward(blob)
+
+    results = []
+    for index, image in enumerate(images):
+        # The output maps are 4 times smaller than the input, drop the cells that only cover the padding
+        rows, cols = image.shape[0] // 4, image.shape[1] // 4
+        results.append(decode_text_boxes(scores[index:index + 1, :, :rows, :cols],
+                                         geometry[index:index + 1, :, :rows, :cols], min_confidence))
+    return results
+
+
+def decode_text_boxes(scores, geometry, min_confidence):
     with timer('Decode predictions'):
         (rects, confidences) = decode_predictions(scores, geometry, min_confidence)
     with timer('Non max suppression'):
-        boxes = imutils.object_detection.non_max_suppression(np.array(rects), probs=confidences)
+        boxes = imutils.object_detection.non_max_suppression(rects, probs=confidences)
+    increment('east_boxes', len(rects))
+    increment('east_boxes_after_nms', len(boxes))
     return boxes
 
 
@@ -242,10 +567,114 @@ def is_checked(image_rect, wanted_ratio=0.7):
     return checked
 
 
+# Both ways of counting the white pixels of the toggles in the Otsu threshold of the whole image give the same states.
+# The summed-area table costs about 1 ns per pixel of the box around the toggles to build, then 1 us per toggle, against
+# 5 us per toggle one crop at a time. With the toggles spread over the whole image the table pays off from about 85
+# toggles on a 500x390 form, 420 on a 1080p screenshot and 1500 on a 4K one. Measured with tests/test_checked_state.py.
+TABLE_MIN_TOGGLES = 50
+TABLE_PIXELS_PER_TOGGLE = 5600
+
+
+def _use_table(box, count):
+    left, top, right, bottom = box
+    return count >= TABLE_MIN_TOGGLES + (right - left) * (bottom - top) / TABLE_PIXELS_PER_TOGGLE
+
+
+def are_checked(white, total, wanted_ratio):
+    # The rule of is_checked for many toggles at once. A toggle entirely outside the image is never checked.
+    ratios = np.divide(white, total, out=np.ones(len(total)), where=total > 0)
+    return ratios < wanted_ratio
+
+
+def _toggles_box(context, x1, y1, x2, y2):
+    # The bounding box of the toggles inside the image, None when no toggle is
+    height, width = context.shape[:2]
+    if not len(x1):
+        return None
+    left, top = max(0, int(x1.min())), max(0, int(y1.min()))
+    right, bottom = min(width, int(x2.max())), min(height, int(y2.max()))
+    return (left, top, right, bottom) if right > left and bottom > top else None
+
+
+def _toggles_table(context, box):
+    # The summed-area table only covers the box, it comes with the origin of the box. Toggles spread over most of the
+    # image share the table of the whole image instead, so the check buttons and the radio buttons don't build two
+    # tables almost as large as the image.
+    height, width = context.shape[:2]
+    left, top, right, bottom = box
+    if 2 * (right - left) * (bottom - top) > width * height:
+        return context.integral(), 0, 0
+    return context.integral(rectangle(left, top, right - left, bottom - top)), left, top
+
+
+@functools.lru_cache(maxsize=None)
+def disc_mask(radius):
+    # The pixels of the square around a circle whose center is inside the circle, the ones circle_sums counts
+    rows, cols = np.mgrid[:2 * radius, :2 * radius] + 0.5 - radius
+    mask = (rows ** 2 + cols ** 2 <= radius ** 2).astype(np.uint8)
+    mask.flags.writeable = False
+    return mask
+
+
+def _crop_counts(otsu, x1, y1, x2, y2, mask=None):
+    # White pixels and pixels of the part of a crop inside the image, only under the mask of the crop if it has one
+    left, top = max(0, x1), max(0, y1)
+    crop = otsu[top:max(0, y2), left:max(0, x2)]
+    if not crop.size:
+        return 0, 0
+    if mask is None:
+        return cv2.countNonZero(crop), crop.size
+
+    mask = mask[top - y1:top - y1 + crop.shape[0], left - x1:left - x1 + crop.shape[1]]
+    return cv2.countNonZero(cv2.bitwise_and(crop, mask)), cv2.countNonZero(mask)
+
+
+def are_squares_checked(context, squares, wanted_ratio=0.7, use_table=None):
+    # The white pixels of every square in the Otsu threshold of the whole image, counted with four lookups in a
+    # summed-area table when there are enough squares to pay for it
+    context = image_context(context)
+    squares = RectArray.from_rects(squares)
+    x, y = squares.x.astype(np.int64), squares.y.astype(np.int64)
+    box = _toggles_box(context, x, y, x + squares.w, y + squares.h)
+    if box is None:
+        return np.zeros(len(squares), dtype=bool)
+
+    if (_use_table(box, len(squares)) if use_table is None else use_table):
+        integral, left, top = _toggles_table(context, box)
+        return are_checked(*rect_sums(integral, x - left, y - top, squares.w, squares.h), wanted_ratio)
+
+    otsu = context.otsu()
+    counts = [_crop_counts(otsu, x1, y1, x1 + w, y1 + h)
+              for x1, y1, w, h in zip(x.tolist(), y.tolist(), squares.w.tolist(), squares.h.tolist())]
+    return are_checked(*np.array(counts, dtype=np.int64).T, wanted_ratio)
+
+
+def are_circles_checked(context, circles, wanted_ratio=0.7, use_table=None):
+    # The same inside every circle, without the corners of the square around it
+    context = image_context(context)
+    center_x, center_y, radius = np.array([(circ.center.x, circ.center.y, circ.radius) for circ in circles],
+                                          dtype=np.int64).reshape(-1, 3).T
+    box = _toggles_box(context, center_x - radius, center_y - radius, center_x + radius, center_y + radius)
+    if box is None:
+        return np.zeros(len(center_x), dtype=bool)
+
+    if (_use_table(box, len(center_x)) if use_table is None else use_table):
+        integral, left, top = _toggles_table(context, box)
+        return are_checked(*circle_sums(integral, center_x - left, center_y - top, radius), wanted_ratio)
+
+    otsu = context.otsu()
+    counts = [_crop_counts(otsu, x - r, y - r, x + r, y + r, disc_mask(r))
+              for x, y, r in zip(center_x.tolist(), center_y.tolist(), radius.tolist())]
+    return are_checked(*np.array(counts, dtype=np.int64).T, wanted_ratio)
+
+
 NOISE_CHARS = ',.?! []'
 
 
-def apply_ocr_on_rectangle(image, rect, padding):
+OCR_CONFIG = "-l eng --oem 1"
+
+
+def crop_padded_roi(image, rect, padding):
     padding_x, padding_y = padding
 
     image_h, image_w = image.shape[:2]
@@ -263,11 +692,27 @@ def apply_ocr_on_rectangle(image, rect, padding):
     end_x = min(image_w, end_x + dx)
     end_y = min(image_h, end_y + dy)
 
-    roi = image[start_y:end_y, start_x:end_x]
+    return image[start_y:end_y, start_x:end_x], (start_x, start_y)
+
+
+def ocr_source_image(context, source='image'):
+    # The image the regions are cropped from, the image itself or one of its planes like 'gray'
+    context = image_context(context)
+    return context.image if source == 'image' else getattr(context, source)()
+
+
+def apply_ocr_on_regions(context, regions, backend=None, mosaic=False, workers=1, source='image'):
+    # Each region is a (rectangle, padding) pair, the raw text of every region is returned in the same order
+    image = ocr_source_image(context, source)
+    rois = [crop_padded_roi(image, rect, padding)[0] for rect, padding in regions]
+
+    if mosaic:
+        return ocr_mosaic(rois, OCR_CONFIG, backend)
+
+    return ocr_rois(rois, OCR_CONFIG, backend, workers)
 
-    config = "-l eng --oem 1"
-    text = pytesseract.image_to_string(roi, config=config)
 
+def clean_ocr_text(text):
     if text:
         text = text.strip(NOISE_CHARS)
         return text
@@ -275,61 +720,112 @@ def apply_ocr_on_rectangle(image, rect, padding):
         return None
 
 
-def apply_ocr_on_rects(image, joined, padding):
+def apply_ocr_on_rectangle(context, rect, padding, backend=None):
+    text, = apply_ocr_on_regions(context, [(rect, padding)], backend)
+
+    return clean_ocr_text(text)
+
+
+def apply_ocr_on_rects(context, joined, padding, backend=None, mosaic=False, workers=1):
     results = []
-    padding_x, padding_y = padding
 
-    image_h, image_w = image.shape[:2]
+    # config = "-l eng --oem 1 --psm 7"
+    texts = apply_ocr_on_regions(context, [(rect, padding) for rect in joined], backend, mosaic, workers)
 
-    for rect in joined:
-        start_x, start_y, w, h = rect
+    for rect, text in zip(joined, texts):
+        if text:
+            start_x, start_y = crop_padded_roi(image_context(context).image, rect, padding)[1]
+            results.append((rectangle(start_x, start_y, rect.w, rect.h), text))
 
-        end_x = start_x + w
-        end_y = start_y + h
+    return results
 
-        dx = int(w * padding_x)
-        dy = int(h * padding_y)
 
-        start_x = max(0, start_x - dx)
-        start_y = max(0, start_y - dy)
-        end_x = min(image_w, end_x + dx)
-        end_y = min(image_h, end_y + dy)
+class OcrRegistry:
+    def __init__(self):
+        # Every (rectangle, padding) region of one analysis is recognized once, no matter how many consumers ask. A
+        # region is cropped from the image, or from the plane of the image named by its source.
+        self._texts = {}
+        self._pending = {}
+        self.requests = 0
+        self.saved_calls = 0
+
+    def request(self, rect, padding, source='image'):
+        region = (rectangle(*rect), tuple(padding), source)
+        self.requests += 1
+        if region in self._texts or region in self._pending:
+            self.saved_calls += 1
+            increment('ocr_calls_saved')
+        else:
+            self._pending[region] = None
+        return region
 
-        roi = image[start_y:end_y, start_x:end_x]
+    def pending(self):
+        return list(self._pending)
 
-        # config = "-l eng --oem 1 --psm 7"
-        config = "-l eng --oem 1"
-        text = pytesseract.image_to_string(roi, config=config)
+    def pending_rois(self, context):
+        return [crop_padded_roi(ocr_source_image(context, source), rect, padding)[0]
+                for rect, padding, source in self._pending]
 
-        if text:
-            results.append((rectangle(start_x, start_y, w, h), text))
+    def fill(self, texts):
+        # texts are the raw texts of the pending regions, in order
+        for region, text in zip(self._pending, texts):
+            self._texts[region] = text
+        self._pending = {}
 
-    return results
+    def resolve(self, context, backend=None, mosaic=False, workers=1):
+        # The regions of each source are recognized together, a mosaic can't mix color and gray crops
+        texts = {}
+        for source in dict.fromkeys(region[2] for region in self._pending):
+            regions = [region for region in self._pending if region[2] == source]
+            texts.update(zip(regions, apply_ocr_on_regions(context, [region[:2] for region in regions], backend,
+                                                           mosaic, workers, source)))
+        self.fill([texts[region] for region in self._pending])
+
+    def text(self, rect, padding, source='image'):
+        return self._texts[(rectangle(*rect), tuple(padding), source)]
+
+
+def _rect_boxes(rects):
+    return [(x, y, x + w, y + h) for x, y, w, h in rects]
 
 
-def detect_buttons(image, rects, text_rects):
-    rects_to_remove = set()
-    for inner_rect, outer_rect in itertools.combinations(rects, 2):
-        if inner_rect not in rects_to_remove \
-                and outer_rect not in rects_to_remove \
-                and is_rect_inside_rect(inner_rect, outer_rect):
-            rects_to_remove.add(outer_rect)
+def detect_buttons(context, rects, text_rects):
+    image = image_context(context).writable_image()
+    rects = list(rects)
+    text_rects = list(text_rects)
+    rects_array = RectArray.from_rects(rects)
 
-    rects = set(rects).difference(rects_to_remove)
+    # Same as going through itertools.combinations(rects, 2): the pairs come in the same order and an outer rectangle
+    # is removed only by an inner one that wasn't removed before
+    inner, outer = GridIndex(rects).query_pairs(_rect_boxes(rects))
+    inside = are_rects_inside_rects(rects_array[inner], rects_array[outer]) & (inner < outer)
+
+    removed = set()
+    for i, j in zip(inner[inside].tolist(), outer[inside].tolist()):
+        if i not in removed:
+            removed.add(j)
+
+    rects = set(rects).difference(rects[j] for j in removed)
     horizontal_rects = [rect for rect in rects if rect.w > rect.h]
+    horizontal_array = RectArray.from_rects(horizontal_rects)
+    text_array = RectArray.from_rects(text_rects)
+
+    texts, candidates = GridIndex(horizontal_rects).query_pairs(_rect_boxes(text_rects))
+    matching = (overlap_ratios(text_array[texts], horizontal_array[candidates]) > 0.8) & \
+        (np.abs(text_array.h[texts] - horizontal_array.h[candidates]) < 0.5 * horizontal_array.h[candidates])
 
     results = []
     checked_rects = set()
     checked_text_rects = set()
 
-    for text_rect, rect in itertools.product(text_rects, horizontal_rects):
-        if rect not in checked_rects and text_rect not in checked_text_rects and \
-                overlap(text_rect, rect) > 0.8 and abs(text_rect.h - rect.h) < 0.5 * rect.h:
+    for t, r in zip(texts[matching].tolist(), candidates[matching].tolist()):
+        if r not in checked_rects and t not in checked_text_rects:
+            rect, text_rect = horizontal_rects[r], text_rects[t]
             # THIS IS NOT A BUG
             cv2.rectangle(image, (rect.x, rect.y), (rect.x + rect.w, rect.y + rect.h), (0, 255, 0), 2)
 
-            checked_rects.add(rect)
-            checked_text_rects.add(text_rect)
+            checked_rects.add(r)
+            checked_text_rects.add(t)
 
             results.append({
                 'text_rectangle': text_rect.to_json(),
@@ -338,61 +834,76 @@ def detect_buttons(image, rects, text_rects):
     return results
 
 
-def detect_check_buttons(gray, rects, text_rects):
+def detect_check_buttons(context, rects, text_rects):
     squares = [rect for rect in rects if abs(rect.w - rect.h) < 20 and rect.w * rect.h < 200]
-    first_results = []
+    text_rects = list(text_rects)
+    squares_array = RectArray.from_rects(squares)
+    text_array = RectArray.from_rects(text_rects)
+
+    # A square goes with the first text rectangle at about the same height, but the text is only associated when its
+    # corner is close to the square
+    texts, candidates = GridIndex([(square.x, square.y, 0, 0) for square in squares]).query_pairs(
+        [(-math.inf, rect.y - 10, math.inf, rect.y + 10) for rect in text_rects])
+    aligned = np.abs(squares_array.y[candidates] - text_array.y[texts]) < 10
+    texts, candidates = texts[aligned], candidates[aligned]
+
+    candidate_squares = squares_array[candidates]
+    close = are_points_inside_circles(text_array.x[texts], text_array.y[texts],
+                                      candidate_squares.x + candidate_squares.w / 2,
+                                      candidate_squares.y + candidate_squares.h / 2, 4 * candidate_squares.w)
 
+    first_results = []
     processed_squares = set()
-    for rect, square in itertools.product(text_rects, squares):
-        # if abs(square.y - rect.y) < 10 and is_inside_circle(point(rect.x, rect.y),
-        #                                                     circle(
-        #                                                         point(square.x + square.w / 2,
-        #                                                               square.y + square.h / 2),
-        #                                                         4 * square.w)):
-        if abs(square.y - rect.y) < 10 and square not in processed_squares:
-            if is_inside_circle(point(rect.x, rect.y),
-                                circle(
-                                    point(square.x + square.w / 2,
-                                          square.y + square.h / 2),
-                                    4 * square.w)):
-                first_results.append((rect, square))
-            else:
-                first_results.append((None, square))
+    for t, s, is_close in zip(texts.tolist(), candidates.tolist(), close.tolist()):
+        if s not in processed_squares:
+            first_results.append((text_rects[t] if is_close else None, squares[s]))
+            processed_squares.add(s)
 
-            processed_squares.add(square)
+    checked = are_squares_checked(context, [square for _, square in first_results], 0.8)
 
     results = []
-
-    for rect, square in first_results:
-        image_rect = gray[square.y: square.y + square.h,
-                     square.x: square.x + square.w]
-        checked = is_checked(image_rect, 0.8)
-
+    for (rect, square), is_square_checked in zip(first_results, checked.tolist()):
         results.append({
             'associated_text_rect': rect.to_json() if rect else None,
             'rectangle': square.to_json(),
-            'is_checked': checked
+            'is_checked': is_square_checked
         })
     return results
 
 
-def detect_radial_buttons(gray, text_rects):
-    circles = detect_circles(gray, 6, 8, 10, 15)
-    first_results = []
-    for rect, circ in itertools.product(text_rects, circles):
-        if circ.center.y > rect.y and is_inside_circle(point(rect.x, rect.y), circle(circ.center, circ.radius * 3)):
-            first_results.append((rect, circ))
+def detect_radial_button_circles(context):
+    return detect_circles(context, 6, 8, 10, 15)
 
-    results = []
-    for rect, circ in first_results:
-        image_rect = gray[circ.center.y - circ.radius: circ.center.y + circ.radius,
-                     circ.center.x - circ.radius: circ.center.x + circ.radius]
-        checked = is_checked(image_rect, 0.75)
 
+def detect_radial_buttons(context, text_rects, circles=None):
+    context = image_context(context)
+    if circles is None:
+        circles = detect_radial_button_circles(context)
+    text_rects = list(text_rects)
+
+    # A text rectangle goes with the circles three radiuses or less away from its corner
+    circles_index = GridIndex([(circ.center.x - 3 * circ.radius, circ.center.y - 3 * circ.radius,
+                                6 * circ.radius, 6 * circ.radius) for circ in circles])
+    texts, candidates = circles_index.query_pairs([(rect.x, rect.y, rect.x, rect.y) for rect in text_rects])
+
+    text_array = RectArray.from_rects(text_rects)
+    center_x, center_y, radius = np.array([(circ.center.x, circ.center.y, circ.radius) for circ in circles],
+                                          dtype=np.int64).reshape(-1, 3).T
+    matching = (center_y[candidates] > text_array.y[texts]) & \
+        are_points_inside_circles(text_array.x[texts], text_array.y[texts], center_x[candidates],
+                                  center_y[candidates], 3 * radius[candidates])
+
+    first_results = [(text_rects[t], circles[c])
+                     for t, c in zip(texts[matching].tolist(), candidates[matching].tolist())]
+
+    checked = are_circles_checked(context, [circ for _, circ in first_results], 0.75)
+
+    results = []
+    for (rect, circ), is_circle_checked in zip(first_results, checked.tolist()):
         results.append({
             'associated_text_rect': rect.to_json(),
             'button_circle': circ.to_json(),
-            'is_checked': checked
+            'is_checked': is_circle_checked
         })
 
     return results
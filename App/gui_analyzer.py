@@ -1,10 +1,17 @@
 import argparse
-import json
+import logging as log
+import os
 import tkinter as tk
 
 import cv2
 
-from application import Application, analyze_image
+from analysis import analyze_image, analyze_image_cached, tiling
+from application import Application
+from batch import analyze_batch, collect_image_paths
+from cache import AnalysisCache
+from metrics import get_metrics
+from ocr import OCR_BACKENDS, DEFAULT_OCR_BACKEND, set_default_ocr_backend, configure_ocr_cache, get_ocr_cache
+from results_io import write_results
 
 
 def main():
@@ -12,26 +19,87 @@ def main():
     parser.add_argument('--model_path', '-m', help='Path to the pb file for the neural network',
                         default='other\\frozen_east_text_detection.pb')
     parser.add_argument('--image_path', '-i', help='Path to the image to analyze')
-    parser.add_argument('--output', '-o', help='Path to the results file to write to', default='results.json')
+    parser.add_argument('--output', '-o',
+                        help='Path to the results file to write to, results.json or results.jsonl in batch mode. '
+                             '.jsonl files get json lines and .msgpack files msgpack records, with an offset index')
+    parser.add_argument('--batch', nargs='+', metavar='SOURCE',
+                        help='Analyze many images: directories, glob patterns or text files with one path per line. '
+                             'The results are appended to the output as json lines and analyzed images are skipped')
+    parser.add_argument('--processes', type=int, help='Number of worker processes in batch mode, one per cpu by default')
     parser.add_argument('--gui', action='store_true', help='Launch GUI for application')
     parser.add_argument('--debug', action='store_true', help='Store intermediate results in debug.json')
+    parser.add_argument('--ocr_backend', choices=sorted(OCR_BACKENDS), default=DEFAULT_OCR_BACKEND,
+                        help='OCR engine to use, tesserocr keeps the language model loaded between regions')
+    parser.add_argument('--mosaic_ocr', action='store_true',
+                        help='Recognize all the labels of an image in a single OCR call on a mosaic of the regions')
+    parser.add_argument('--ocr_workers', type=int, default=1, metavar='N',
+                        help='Number of regions of an image recognized at the same time')
+    parser.add_argument('--ocr_cache_dir', help='Also keep the OCR results of the regions on disk in this directory')
+    parser.add_argument('--ocr_cache_size', type=int, default=64,
+                        help='Maximum size in megabytes of the OCR results kept on disk')
+    parser.add_argument('--cache_dir', default=os.path.join(os.path.expanduser('~'), '.cache', 'gui_analyzer'),
+                        help='Directory where the results of analyzed images are kept')
+    parser.add_argument('--cache_size', type=int, default=256,
+                        help='Maximum size in megabytes of the cached results')
+    parser.add_argument('--cache_max_age', type=float, default=30, help='Days after which cached results expire')
+    parser.add_argument('--no-cache', action='store_true', help='Always analyze the image, ignoring cached results')
+    parser.add_argument('--tile_size', type=int, default=0,
+                        help='Analyze images larger than this in overlapping tiles of at most this size, like 1024 '
+                             'for captures too large for the network, 0 (the default) to disable')
+    parser.add_argument('--tile_overlap', type=int, default=128, help='Overlap in pixels between neighbouring tiles')
+    parser.add_argument('--tile_workers', type=int, default=1, help='Number of tiles analyzed at the same time')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='Write the stage durations and workload counters to this file, in the Prometheus text '
+                             'format for .prom and .txt files and as json otherwise')
     args = parser.parse_args()
 
-    if not args.gui:
+    if args.tile_size and not 0 <= args.tile_overlap < args.tile_size:
+        parser.error('--tile_overlap must be at least 0 and less than --tile_size')
+    tiles = tiling(args.tile_size, args.tile_overlap, args.tile_workers) if args.tile_size else None
+
+    set_default_ocr_backend(args.ocr_backend)
+    configure_ocr_cache(directory=args.ocr_cache_dir, max_bytes=args.ocr_cache_size * 1024 * 1024)
+
+    if args.batch:
+        output = args.output or 'results.jsonl'
+        failed = analyze_batch(collect_image_paths(args.batch), output, args.model_path, args.processes,
+                               ocr_backend=args.ocr_backend, mosaic_ocr=args.mosaic_ocr, ocr_workers=args.ocr_workers,
+                               tiles=tiles,
+                               ocr_cache_dir=args.ocr_cache_dir, ocr_cache_size=args.ocr_cache_size * 1024 * 1024,
+                               cache_dir=None if args.no_cache else args.cache_dir,
+                               cache_size=args.cache_size * 1024 * 1024,
+                               cache_max_age=args.cache_max_age * 24 * 60 * 60)
+        if args.metrics:
+            get_metrics().write(args.metrics)
+        if failed:
+            raise SystemExit(f'{failed} images could not be analyzed')
+    elif not args.gui:
         if not args.model_path or not args.image_path:
             parser.error('The following parameters are required for non-gui mode: --model_path, --image_path')
 
         image = cv2.imread(args.image_path)
-        results = analyze_image(image, args.model_path)
+        if args.no_cache:
+            results = analyze_image(image, args.model_path, mosaic_ocr=args.mosaic_ocr, ocr_workers=args.ocr_workers,
+                                    tiles=tiles)
+        else:
+            cache = AnalysisCache(args.cache_dir, args.cache_size * 1024 * 1024, args.cache_max_age * 24 * 60 * 60)
+            results = analyze_image_cached(image, args.model_path, cache, mosaic_ocr=args.mosaic_ocr,
+                                           ocr_workers=args.ocr_workers, tiles=tiles)
+
+        ocr_cache_stats = get_ocr_cache().stats()
+        log.info(f'OCR cache: {ocr_cache_stats["hits"]} hits ({ocr_cache_stats["disk_hits"]} from disk), '
+                 f'{ocr_cache_stats["misses"]} misses')
+
+        write_results(args.output or 'results.json', results, args.image_path)
 
-        with open(args.output, 'w') as file:
-            file.write(json.dumps(results, indent=2))
+        if args.metrics:
+            get_metrics().write(args.metrics)
     else:
         main_window = tk.Tk()
         main_window.title('GUI Analyzer')
         main_window.geometry('1080x720')
 
-        Application(main_window, args.image_path, args.output, args.model_path)
+        Application(main_window, args.image_path, args.output or 'results.json', args.model_path)
 
         main_window.mainloop()
 
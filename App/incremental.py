@@ -0,0 +1,157 @@
+import copy
+import logging as log
+
+import cv2
+import numpy as np
+
+from analysis import analyze_image
+from utils import rectangle, join, merge_overlapping_rectangles, overlap
+
+# The EAST network needs at least 32 pixels in each direction
+MIN_REGION_SIZE = 32
+
+
+def widget_bounds(kind, widget):
+    if kind == 'radial_buttons':
+        circ = widget['button_circle']
+        center, radius = circ['center'], circ['radius']
+        bounds = rectangle(center['x'] - radius, center['y'] - radius, 2 * radius, 2 * radius)
+        text_rect = widget['associated_text_rect']
+    elif kind == 'buttons':
+        bounds = rectangle.from_json(widget['rectangle'])
+        text_rect = widget['text_rectangle']
+    else:
+        bounds = rectangle.from_json(widget['rectangle'])
+        text_rect = widget['associated_text_rect']
+
+    if text_rect:
+        bounds = join(bounds, rectangle.from_json(text_rect))
+    return bounds
+
+
+def translate_widget(kind, widget, dx, dy):
+    widget = copy.deepcopy(widget)
+
+    def move(json_rect):
+        if json_rect:
+            json_rect['x'] += dx
+            json_rect['y'] += dy
+
+    if kind == 'radial_buttons':
+        move(widget['button_circle']['center'])
+        move(widget['associated_text_rect'])
+    elif kind == 'buttons':
+        move(widget['rectangle'])
+        move(widget['text_rectangle'])
+    else:
+        move(widget['rectangle'])
+        move(widget['associated_text_rect'])
+    return widget
+
+
+def _touches(r1, r2):
+    # Like overlap, but rectangles sharing only an edge count as touching
+    return r1.x <= r2.x + r2.w and r2.x <= r1.x + r1.w and r1.y <= r2.y + r2.h and r2.y <= r1.y + r1.h
+
+
+def _clamp(rect, image_w, image_h):
+    x, y = max(0, rect.x), max(0, rect.y)
+    return rectangle(x, y, min(image_w, rect.x + rect.w) - x, min(image_h, rect.y + rect.h) - y)
+
+
+def find_dirty_regions(previous_image, image, previous_results, margin=16, threshold=0):
+    image_h, image_w = image.shape[:2]
+
+    diff = cv2.absdiff(previous_image, image)
+    if diff.ndim == 3:
+        diff = diff.max(axis=2)
+    mask = np.uint8(diff > threshold) * 255
+
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    regions = [rectangle(*cv2.boundingRect(contour)) for contour in contours]
+    if not regions:
+        return []
+
+    # A region grows by the margin, up to the minimum size of the network and over every previous widget it touches,
+    # so no widget is ever cut in two by the border of a region
+    bounds = [widget_bounds(kind, widget) for kind in previous_results for widget in previous_results[kind]]
+
+    grown = []
+    for x, y, w, h in regions:
+        dx = margin + max(0, MIN_REGION_SIZE - w) // 2
+        dy = margin + max(0, MIN_REGION_SIZE - h) // 2
+        grown.append(_clamp(rectangle(x - dx, y - dy, w + 2 * dx, h + 2 * dy), image_w, image_h))
+
+    regions = merge_overlapping_rectangles(grown)
+    while True:
+        grown = set()
+        for region in regions:
+            for widget_rect in bounds:
+                if _touches(region, widget_rect):
+                    region = join(region, widget_rect)
+            grown.add(_clamp(region, image_w, image_h))
+
+        grown = merge_overlapping_rectangles(grown)
+        if grown == regions:
+            return sorted(regions)
+        regions = grown
+
+
+def _is_cut(bounds, region, image_w, image_h):
+    # A widget touching the border of its region, where the region doesn't end at the image border, may be missing
+    # the part outside of the region
+    return any([
+        bounds.x <= region.x and region.x > 0,
+        bounds.y <= region.y and region.y > 0,
+        bounds.x + bounds.w >= region.x + region.w and region.x + region.w < image_w,
+        bounds.y + bounds.h >= region.y + region.h and region.y + region.h < image_h
+    ])
+
+
+def analyze_image_incremental(previous_image, previous_results, image, model_path, margin=16, max_dirty_ratio=0.5,
+                              **options):
+    # The analysis draws the buttons it finds into its input. It gets a copy, so the frame stays as it was captured
+    # for the caller and for the comparison with the next frame.
+    if previous_image is None or previous_image.shape != image.shape:
+        return analyze_image(image.copy(), model_path, **options)
+
+    image_h, image_w = image.shape[:2]
+
+    regions = find_dirty_regions(previous_image, image, previous_results, margin)
+    if not regions:
+        log.info("The image did not change, reusing the previous results")
+        return copy.deepcopy(previous_results)
+
+    dirty_area = sum(region.w * region.h for region in regions)
+    if dirty_area > max_dirty_ratio * image_w * image_h:
+        log.info(f"{100 * dirty_area / (image_w * image_h):.0f}% of the image changed, analyzing all of it")
+        return analyze_image(image.copy(), model_path, **options)
+
+    log.info(f"Analyzing {len(regions)} changed regions covering {100 * dirty_area / (image_w * image_h):.1f}% "
+             f"of the image")
+
+    # The widgets outside of the changed regions are carried over with their text
+    results = {kind: [copy.deepcopy(widget) for widget in widgets
+                      if not any(overlap(widget_bounds(kind, widget), region) for region in regions)]
+               for kind, widgets in previous_results.items()}
+
+    for region in regions:
+        roi = image[region.y:region.y + region.h, region.x:region.x + region.w].copy()
+        region_results = analyze_image(roi, model_path, **options)
+
+        for kind, widgets in region_results.items():
+            for widget in widgets:
+                widget = translate_widget(kind, widget, region.x, region.y)
+                if not _is_cut(widget_bounds(kind, widget), region, image_w, image_h):
+                    results[kind].append(widget)
+
+    return results
+
+
+def analyze_sequence(images, model_path, **options):
+    # Every frame is analyzed relative to the one before it, like the screenshots taken after every click
+    previous_image, previous_results = None, None
+    for image in images:
+        previous_results = analyze_image_incremental(previous_image, previous_results, image, model_path, **options)
+        previous_image = image
+        yield previous_results
@@ -0,0 +1,167 @@
+import bisect
+import json
+import re
+import threading
+
+# Upper bounds in seconds of the duration histogram buckets, the same as the Prometheus client defaults plus a few
+# for the long OCR and network stages
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0,
+                    30.0, 60.0)
+
+PROMETHEUS_PREFIX = 'gui_analyzer'
+
+
+def metric_name(operation_name):
+    # 'Find contours' becomes find_contours
+    return re.sub(r'[^0-9a-zA-Z]+', '_', operation_name).strip('_').lower()
+
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last count is for the values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Estimated like Prometheus' histogram_quantile, by interpolating inside the bucket of the quantile
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def to_json(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+    def merge(self, json_histogram):
+        if tuple(json_histogram['buckets']) != self.buckets:
+            raise ValueError('Only histograms with the same buckets can be merged')
+
+        self.counts = [count + other for count, other in zip(self.counts, json_histogram['counts'])]
+        self.sum += json_histogram['sum']
+        self.count += json_histogram['count']
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def histogram(self, name):
+        with self._lock:
+            return self._histograms.get(name)
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            snapshot = {
+                'durations': {name: histogram.to_json() for name, histogram in sorted(self._histograms.items())},
+                'counters': dict(sorted(self._counters.items())),
+            }
+            if reset:
+                self._histograms = {}
+                self._counters = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        # Adds a snapshot taken in another process, like a batch worker, to this registry
+        with self._lock:
+            for name, json_histogram in snapshot['durations'].items():
+                histogram = self._histograms.get(name)
+                if histogram is None:
+                    histogram = self._histograms[name] = Histogram(json_histogram['buckets'])
+                histogram.merge(json_histogram)
+            for name, amount in snapshot['counters'].items():
+                self._counters[name] = self._counters.get(name, 0) + amount
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+
+    def to_json(self):
+        snapshot = self.snapshot()
+        with self._lock:
+            for name, json_histogram in snapshot['durations'].items():
+                histogram = self._histograms.get(name)
+                if histogram is not None:
+                    json_histogram['median'] = histogram.quantile(0.5)
+                    json_histogram['p95'] = histogram.quantile(0.95)
+        return snapshot
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        if snapshot['durations']:
+            name = f'{PROMETHEUS_PREFIX}_duration_seconds'
+            lines.append(f'# HELP {name} Duration of the analysis operations')
+            lines.append(f'# TYPE {name} histogram')
+            for operation, histogram in snapshot['durations'].items():
+                cumulative = 0
+                for bound, count in zip(histogram['buckets'], histogram['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{operation="{operation}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{operation="{operation}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'{name}_sum{{operation="{operation}"}} {histogram["sum"]}')
+                lines.append(f'{name}_count{{operation="{operation}"}} {histogram["count"]}')
+
+        for counter, value in snapshot['counters'].items():
+            name = f'{PROMETHEUS_PREFIX}_{counter}_total'
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # Prometheus text format for .prom and .txt files, json for everything else
+        with open(path, 'w') as file:
+            if path.lower().endswith(('.prom', '.txt')):
+                file.write(self.to_prometheus())
+            else:
+                file.write(json.dumps(self.to_json(), indent=2))
+
+
+_metrics = MetricsRegistry()
+
+
+def get_metrics():
+    return _metrics
+
+
+def observe(name, seconds):
+    _metrics.observe(name, seconds)
+
+
+def increment(name, amount=1):
+    _metrics.increment(name, amount)
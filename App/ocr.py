@@ -0,0 +1,401 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import queue
+import shlex
+import threading
+import weakref
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pytesseract
+
+from cache import LRUCache, DiskCache
+from metrics import increment
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+
+ocr_word = namedtuple('ocr_word', 'block par line left top width height text')
+
+
+def parse_tesseract_config(config):
+    # Only the options we pass to the tesseract command line are understood: -l, --oem and --psm
+    language, oem, psm = 'eng', None, None
+
+    args = shlex.split(config)
+    for option, value in zip(args, args[1:]):
+        if option == '-l':
+            language = value
+        elif option == '--oem':
+            oem = int(value)
+        elif option == '--psm':
+            psm = int(value)
+
+    return language, oem, psm
+
+
+class PytesseractBackend:
+    name = 'pytesseract'
+
+    def image_to_string(self, image, config):
+        return pytesseract.image_to_string(image, config=config)
+
+    def image_to_data(self, image, config):
+        data = pytesseract.image_to_data(image, config=config, output_type=pytesseract.Output.DICT)
+        columns = zip(data['block_num'], data['par_num'], data['line_num'],
+                      data['left'], data['top'], data['width'], data['height'], data['text'])
+        return [ocr_word(*column) for column in columns if str(column[-1]).strip()]
+
+
+class TesserocrBackend:
+    name = 'tesserocr'
+
+    def __init__(self, pool_size=4):
+        if tesserocr is None:
+            raise RuntimeError('The tesserocr OCR backend needs the tesserocr package')
+
+        # Every handle keeps its language model loaded. A handle is used by one thread at a time, so there is a small
+        # pool of them for each (language, oem) pair.
+        self._pool_size = pool_size
+        self._pools = {}
+        self._created = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, language, oem):
+        key = (language, oem)
+        with self._lock:
+            pool = self._pools.setdefault(key, queue.LifoQueue())
+            if pool.empty() and self._created.get(key, 0) < self._pool_size:
+                self._created[key] = self._created.get(key, 0) + 1
+                if oem is None:
+                    return tesserocr.PyTessBaseAPI(lang=language)
+                return tesserocr.PyTessBaseAPI(lang=language, oem=tesserocr.OEM(oem))
+        return pool.get()
+
+    def _release(self, language, oem, api):
+        self._pools[(language, oem)].put(api)
+
+    def _recognize(self, image, config, extract):
+        language, oem, psm = parse_tesseract_config(config)
+
+        api = self._acquire(language, oem)
+        try:
+            api.SetPageSegMode(tesserocr.PSM.AUTO if psm is None else tesserocr.PSM(psm))
+
+            # The pixels are handed to tesseract as they are, like pytesseract does for numpy images
+            image = np.ascontiguousarray(image)
+            height, width = image.shape[:2]
+            channels = 1 if image.ndim == 2 else image.shape[2]
+            api.SetImageBytes(image.tobytes(), width, height, channels, width * channels)
+
+            return extract(api)
+        finally:
+            self._release(language, oem, api)
+
+    def image_to_string(self, image, config):
+        return self._recognize(image, config, lambda api: api.GetUTF8Text())
+
+    def image_to_data(self, image, config):
+        # Same tab separated layout as tesseract's tsv output:
+        # level page block par line word left top width height conf text
+        tsv = self._recognize(image, config, lambda api: api.GetTSVText(0))
+
+        words = []
+        for row in tsv.splitlines():
+            columns = row.split('\t')
+            if len(columns) == 12 and columns[11].strip():
+                words.append(ocr_word(*map(int, columns[2:5]), *map(int, columns[6:10]), columns[11]))
+        return words
+
+
+OCR_BACKENDS = {
+    PytesseractBackend.name: PytesseractBackend,
+    TesserocrBackend.name: TesserocrBackend,
+}
+
+# The in process engine is used when it is installed, pytesseract is the fallback
+DEFAULT_OCR_BACKEND = TesserocrBackend.name if tesserocr is not None else PytesseractBackend.name
+
+_ocr_backends = {}
+_ocr_backends_lock = threading.Lock()
+_default_ocr_backend = DEFAULT_OCR_BACKEND
+
+
+def get_ocr_backend(name=None):
+    name = name or _default_ocr_backend
+    with _ocr_backends_lock:
+        backend = _ocr_backends.get(name)
+        if backend is None:
+            backend = OCR_BACKENDS[name]()
+            _ocr_backends[name] = backend
+    return backend
+
+
+def set_default_ocr_backend(name):
+    global _default_ocr_backend
+
+    if name not in OCR_BACKENDS:
+        raise ValueError(f'Unknown OCR backend {name}, expected one of {", ".join(OCR_BACKENDS)}')
+    _default_ocr_backend = name
+
+
+class OcrCache:
+    def __init__(self, max_entries=4096, directory=None, max_bytes=64 * 1024 * 1024):
+        self._memory = LRUCache(max_entries)
+        self._disk = DiskCache(directory, max_bytes) if directory else None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(roi, config, backend_name):
+        digest = hashlib.sha1(f'{backend_name}|{config}|{roi.shape}|{roi.dtype}|'.encode())
+        digest.update(np.ascontiguousarray(roi).data)
+        return digest.hexdigest()
+
+    def get(self, key):
+        text = self._memory.get(key)
+        from_disk = False
+        if text is None and self._disk is not None:
+            text = self._disk.get(key)
+            if text is not None:
+                from_disk = True
+                self._memory.put(key, text)
+
+        with self._lock:
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.disk_hits += from_disk
+
+        if text is None:
+            increment('ocr_cache_misses')
+        else:
+            increment('ocr_cache_hits')
+            increment('ocr_cache_disk_hits', from_disk)
+        return text
+
+    def put(self, key, text):
+        self._memory.put(key, text)
+        if self._disk is not None:
+            self._disk.put(key, text)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+
+_ocr_cache = OcrCache()
+
+
+def get_ocr_cache():
+    return _ocr_cache
+
+
+def configure_ocr_cache(enabled=True, max_entries=4096, directory=None, max_bytes=64 * 1024 * 1024):
+    global _ocr_cache
+
+    _ocr_cache = OcrCache(max_entries, directory, max_bytes) if enabled else None
+
+
+def _lookup_cache(rois, config, backend_name):
+    # The texts found in the cache, None for the others, and the indices of the missing regions by cache key.
+    # Identical regions share a key, so they are only recognized once.
+    increment('ocr_regions', len(rois))
+
+    cache = _ocr_cache
+    if cache is None:
+        return None, [None] * len(rois), {index: [index] for index in range(len(rois))}
+
+    keys = [cache.key(roi, config, backend_name) for roi in rois]
+    texts = [cache.get(key) for key in keys]
+
+    missing = {}
+    for index, text in enumerate(texts):
+        if text is None:
+            missing.setdefault(keys[index], []).append(index)
+
+    return cache, texts, missing
+
+
+def _fill_recognized(cache, texts, missing, recognized):
+    for (key, indices), text in zip(missing.items(), recognized):
+        # Failed regions are not cached, the next analysis tries them again
+        if cache is not None and text is not None:
+            cache.put(key, text)
+        for index in indices:
+            texts[index] = text
+
+
+def _recognize_with_cache(rois, config, backend_name, recognize):
+    # recognize gets the regions that are not in the cache
+    cache, texts, missing = _lookup_cache(rois, config, backend_name)
+    if missing:
+        _fill_recognized(cache, texts, missing, recognize([rois[indices[0]] for indices in missing.values()]))
+    return texts
+
+
+async def _recognize_with_cache_async(rois, config, backend_name, recognize):
+    cache, texts, missing = _lookup_cache(rois, config, backend_name)
+    if missing:
+        _fill_recognized(cache, texts, missing, await recognize([rois[indices[0]] for indices in missing.values()]))
+    return texts
+
+
+_verified_engines = set()
+
+
+def verify_ocr_engine(ocr_backend, config):
+    # A missing engine or a bad config fails on any image. A blank image is recognized once per backend and config,
+    # so these errors are raised to the caller and only the errors of a region are left to the region.
+    key = (ocr_backend.name, config)
+    if key not in _verified_engines:
+        ocr_backend.image_to_string(np.full((32, 32), 255, dtype=np.uint8), config)
+        _verified_engines.add(key)
+
+
+def ocr_rois(rois, config, backend=None, workers=1):
+    ocr_backend = get_ocr_backend(backend)
+    if rois:
+        verify_ocr_engine(ocr_backend, config)
+
+    def recognize(roi):
+        # A region that can't be recognized must not take down the other regions of the image
+        increment('ocr_calls')
+        try:
+            return ocr_backend.image_to_string(roi, config)
+        except Exception:
+            increment('ocr_failures')
+            logging.exception(f'OCR failed on a {roi.shape[1]}x{roi.shape[0]} region')
+            return None
+
+    def recognize_all(missing_rois):
+        if workers <= 1 or len(missing_rois) <= 1:
+            return [recognize(roi) for roi in missing_rois]
+
+        # The regions are independent and the OCR engine runs outside of the GIL. map keeps the order of the regions.
+        with ThreadPoolExecutor(max_workers=min(workers, len(missing_rois))) as executor:
+            return list(executor.map(recognize, missing_rois))
+
+    return _recognize_with_cache(rois, config, ocr_backend.name, recognize_all)
+
+
+TESSERACT_COMMAND = 'tesseract'
+
+# Default number of tesseract subprocesses running at the same time in an event loop
+OCR_SUBPROCESS_LIMIT = os.cpu_count() or 1
+
+_ocr_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_ocr_semaphore(limit=None):
+    # One semaphore per event loop, shared by all the images analyzed in it
+    loop = asyncio.get_running_loop()
+    semaphore = _ocr_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.BoundedSemaphore(limit or OCR_SUBPROCESS_LIMIT)
+        _ocr_semaphores[loop] = semaphore
+    return semaphore
+
+
+async def tesseract_image_to_string_async(image, config):
+    if not image.size:
+        raise ValueError('Empty image')
+
+    # pytesseract hands numpy images to tesseract as RGB, the channels are swapped the same way so both read the
+    # same pixels
+    _, png = cv2.imencode('.png', image[..., ::-1] if image.ndim == 3 else image)
+
+    process = await asyncio.create_subprocess_exec(TESSERACT_COMMAND, 'stdin', 'stdout', *shlex.split(config),
+                                                   stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate(png.tobytes())
+    if process.returncode:
+        raise RuntimeError(f'tesseract exited with {process.returncode}: {stderr.decode(errors="replace").strip()}')
+    return stdout.decode('utf-8')
+
+
+async def verify_ocr_engine_async(config):
+    # The same check for the tesseract subprocesses, which read the same pixels as the pytesseract backend
+    key = (PytesseractBackend.name, config)
+    if key not in _verified_engines:
+        await tesseract_image_to_string_async(np.full((32, 32), 255, dtype=np.uint8), config)
+        _verified_engines.add(key)
+
+
+async def ocr_rois_async(rois, config, semaphore=None):
+    semaphore = semaphore or get_ocr_semaphore()
+    if rois:
+        await verify_ocr_engine_async(config)
+
+    async def recognize(roi):
+        async with semaphore:
+            increment('ocr_calls')
+            try:
+                return await tesseract_image_to_string_async(roi, config)
+            except Exception:
+                increment('ocr_failures')
+                logging.exception(f'OCR failed on a {roi.shape[1]}x{roi.shape[0]} region')
+                return None
+
+    async def recognize_all(missing_rois):
+        return await asyncio.gather(*(recognize(roi) for roi in missing_rois))
+
+    # Same engine, config and pixels as the pytesseract backend, so the two share their cache entries
+    return await _recognize_with_cache_async(rois, config, PytesseractBackend.name, recognize_all)
+
+
+MOSAIC_GAP = 16
+
+
+def ocr_mosaic(rois, config, backend=None):
+    ocr_backend = get_ocr_backend(backend)
+
+    # A word read from a mosaic can differ from the same region read alone, so the two are cached separately
+    return _recognize_with_cache(rois, config + ' mosaic', ocr_backend.name,
+                                 lambda missing: _ocr_mosaic(missing, config, ocr_backend))
+
+
+def _ocr_mosaic(rois, config, ocr_backend):
+    # All the crops are stacked on a white canvas with white gaps between them, so every text line of the canvas
+    # belongs to a single crop. One call recognizes everything and the words are sent back to the crop they were in.
+    texts = [''] * len(rois)
+    indices = [index for index, roi in enumerate(rois) if roi.size]
+    if not indices:
+        return texts
+
+    width = max(rois[index].shape[1] for index in indices) + 2 * MOSAIC_GAP
+    height = sum(rois[index].shape[0] for index in indices) + (len(indices) + 1) * MOSAIC_GAP
+    canvas = np.full((height, width) + rois[indices[0]].shape[2:], 255, dtype=np.uint8)
+
+    tops = []
+    top = MOSAIC_GAP
+    for index in indices:
+        roi_h, roi_w = rois[index].shape[:2]
+        canvas[top:top + roi_h, MOSAIC_GAP:MOSAIC_GAP + roi_w] = rois[index]
+        tops.append(top)
+        top += roi_h + MOSAIC_GAP
+
+    increment('ocr_calls')
+    lines = [{} for _ in indices]
+    for word in ocr_backend.image_to_data(canvas, config):
+        center_y = word.top + word.height / 2
+        slot = bisect.bisect_right(tops, center_y) - 1
+        if slot >= 0 and center_y < tops[slot] + rois[indices[slot]].shape[0]:
+            lines[slot].setdefault((word.block, word.par, word.line), []).append(word.text)
+
+    for slot, index in enumerate(indices):
+        texts[index] = '\n'.join(' '.join(words) for words in lines[slot].values())
+
+    return texts
@@ -0,0 +1,268 @@
+import json
+import os
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'json'
+JSON_LINES = 'jsonl'
+MSGPACK = 'msgpack'
+
+FORMAT_EXTENSIONS = {
+    '.json': JSON,
+    '.jsonl': JSON_LINES,
+    '.ndjson': JSON_LINES,
+    '.msgpack': MSGPACK,
+    '.mpk': MSGPACK,
+}
+
+INDEX_SUFFIX = '.idx'
+
+
+def detect_results_format(path):
+    return FORMAT_EXTENSIONS.get(os.path.splitext(path)[1].lower(), JSON)
+
+
+def streaming_results_format(path):
+    # Streaming writers can't append to a single json document, they write json lines instead
+    results_format = detect_results_format(path)
+    return JSON_LINES if results_format == JSON else results_format
+
+
+def _check_format(results_format):
+    if results_format == MSGPACK and msgpack is None:
+        raise RuntimeError('The msgpack results format needs the msgpack package')
+
+
+def write_results(path, results, image_path=None):
+    # A json file holds the results of one image, like results.json always did. The streaming formats get a record
+    # with the image path.
+    if detect_results_format(path) == JSON:
+        with open(path, 'w') as file:
+            file.write(json.dumps(results, indent=2))
+    else:
+        with ResultsWriter(path, append=False) as writer:
+            writer.write(image_path, results)
+
+
+def _encode(results_format, record):
+    if results_format == MSGPACK:
+        return msgpack.packb(record, use_bin_type=True)
+    return (json.dumps(record) + '\n').encode()
+
+
+def _decode(results_format, data):
+    if results_format == MSGPACK:
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
+
+
+def _scan_records(file, results_format, start):
+    # (image path, offset, length) of every complete record after start. A record cut short by an interrupted run
+    # ends the scan.
+    file.seek(start)
+    if results_format == MSGPACK:
+        unpacker = msgpack.Unpacker(file, raw=False)
+        offset = start
+        while True:
+            try:
+                record = unpacker.unpack()
+            except msgpack.OutOfData:
+                return
+            except ValueError:
+                return
+            end = start + unpacker.tell()
+            yield record.get('image'), offset, end - offset
+            offset = end
+    else:
+        offset = start
+        for line in file:
+            if not line.endswith(b'\n'):
+                return
+            try:
+                image_path = json.loads(line)['image']
+            except (ValueError, KeyError, TypeError):
+                return
+            yield image_path, offset, len(line)
+            offset += len(line)
+
+
+class ResultsIndex:
+    def __init__(self, path, results_format):
+        # The sidecar file has one json line [image path, offset, length] per record of the results file, so a reader
+        # can list the images and seek to one of them without parsing the results
+        self._path = path
+        self._index_path = path + INDEX_SUFFIX
+        self._format = results_format
+        self.entries = []
+        self.end = 0
+
+    def load(self):
+        size = os.path.getsize(self._path) if os.path.exists(self._path) else 0
+
+        entries = []
+        if os.path.exists(self._index_path):
+            with open(self._index_path, 'r') as file:
+                for line in file:
+                    try:
+                        image_path, offset, length = json.loads(line)
+                    except ValueError:
+                        break
+                    entries.append((image_path, offset, length))
+
+        # The index is only trusted up to where it matches the results file, the rest of the file is scanned
+        end = 0
+        for count, (_, offset, length) in enumerate(entries):
+            if offset != end or offset + length > size:
+                entries = entries[:count]
+                break
+            end = offset + length
+
+        scanned = []
+        if end < size:
+            with open(self._path, 'rb') as file:
+                scanned = list(_scan_records(file, self._format, end))
+        self.entries = entries + scanned
+        self.end = scanned[-1][1] + scanned[-1][2] if scanned else end
+
+        if scanned or len(entries) != self._count_lines():
+            self._rewrite()
+        return self
+
+    def _count_lines(self):
+        if not os.path.exists(self._index_path):
+            return -1
+        with open(self._index_path, 'r') as file:
+            return sum(1 for _ in file)
+
+    def _rewrite(self):
+        # A reader without write access to the directory still works, it just scans again next time
+        temp_path = f'{self._index_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'w') as file:
+                for entry in self.entries:
+                    file.write(json.dumps(entry) + '\n')
+            os.replace(temp_path, self._index_path)
+        except OSError:
+            pass
+
+    def append(self, file, image_path, offset, length):
+        entry = (image_path, offset, length)
+        self.entries.append(entry)
+        self.end = offset + length
+        file.write(json.dumps(entry) + '\n')
+
+
+class ResultsWriter:
+    def __init__(self, path, results_format=None, append=True):
+        self._format = results_format or streaming_results_format(path)
+        _check_format(self._format)
+
+        if not append:
+            for stale_path in (path, path + INDEX_SUFFIX):
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+
+        # Whatever an interrupted run left after the last complete record is dropped before appending
+        self._index = ResultsIndex(path, self._format).load()
+        with open(path, 'ab') as file:
+            file.truncate(self._index.end)
+
+        self._file = open(path, 'ab')
+        self._index_file = open(path + INDEX_SUFFIX, 'a')
+
+    def images(self):
+        return [image_path for image_path, _, _ in self._index.entries]
+
+    def write(self, image_path, results):
+        data = _encode(self._format, {'image': image_path, 'results': results})
+        offset = self._index.end
+        self._file.write(data)
+        self._file.flush()
+        self._index.append(self._index_file, image_path, offset, len(data))
+        self._index_file.flush()
+
+    def close(self):
+        self._file.close()
+        self._index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResultsReader:
+    def __init__(self, path, results_format=None):
+        self._path = path
+        self._format = results_format or detect_results_format(path)
+        _check_format(self._format)
+
+        self._single = None
+        self._entries = None
+
+    def _load(self):
+        if self._entries is not None:
+            return
+
+        if self._format == JSON:
+            # A whole json document: the results of one image, or json lines saved with a .json name
+            with open(self._path, 'r') as file:
+                content = file.read()
+            try:
+                self._single = json.loads(content)
+                self._entries = [(None, 0, len(content))]
+                return
+            except ValueError:
+                self._format = JSON_LINES
+
+        self._entries = ResultsIndex(self._path, self._format).load().entries
+        self._offsets = {}
+        for position, (image_path, _, _) in enumerate(self._entries):
+            self._offsets.setdefault(image_path, position)
+
+    def images(self):
+        self._load()
+        return [image_path for image_path, _, _ in self._entries]
+
+    def __len__(self):
+        self._load()
+        return len(self._entries)
+
+    def __contains__(self, image_path):
+        self._load()
+        return self._single is None and image_path in self._offsets
+
+    def _read(self, file, position):
+        image_path, offset, length = self._entries[position]
+        file.seek(offset)
+        return image_path, _decode(self._format, file.read(length))['results']
+
+    def get(self, image_path=None):
+        # The results of one image. A file with the results of a single image returns them for any path.
+        self._load()
+        if self._single is not None:
+            return self._single
+        if image_path is None:
+            if len(self._entries) != 1:
+                raise KeyError('The results file has the results of several images, pick one')
+            position = 0
+        else:
+            position = self._offsets[image_path]
+
+        with open(self._path, 'rb') as file:
+            return self._read(file, position)[1]
+
+    def __iter__(self):
+        # (image path, results) of every record, parsed one at a time
+        self._load()
+        if self._single is not None:
+            yield None, self._single
+            return
+
+        with open(self._path, 'rb') as file:
+            for position in range(len(self._entries)):
+                yield self._read(file, position)
@@ -0,0 +1,281 @@
+import argparse
+import json
+import logging as log
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import cv2
+import numpy as np
+
+from analysis import ANALYSIS_PARAMETERS, analyze_image, analyze_text_future, tiling, needs_tiling
+from detection import detect_text_batch, get_text_detector, image_context
+from metrics import get_metrics, increment, observe
+from ocr import OCR_BACKENDS, DEFAULT_OCR_BACKEND, set_default_ocr_backend, get_ocr_backend
+
+FORMAT = '[%(asctime)s] [%(levelname)s] : %(message)s'
+
+
+class TextDetectionBatcher:
+    def __init__(self, model_path, batch_size=8, max_wait=0.01, pad=False):
+        # Requests arriving within max_wait seconds of the first one with the same network input size share its forward
+        # pass. With padding, images of different sizes go through the same pass too, but the small ones pay for the
+        # padded area and the text found near their right and bottom edges can differ from an image analyzed alone.
+        self._model_path = model_path
+        self._batch_size = batch_size
+        self._max_wait = max_wait
+        self._pad = pad
+        self._queue = queue.Queue()
+
+        self._thread = threading.Thread(target=self._run, name='text-detection-batcher', daemon=True)
+        self._thread.start()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, context):
+        future = Future()
+        self._queue.put((context, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = time.perf_counter() + self._max_wait
+        while len(batch) < self._batch_size:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if item is None:
+                # Finish this batch, then stop
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            start = time.perf_counter()
+            for _, _, submitted in batch:
+                observe('server_queue_wait', start - submitted)
+            increment('server_batches')
+            increment('server_batched_images', len(batch))
+
+            try:
+                results = detect_text_batch([context for context, _, _ in batch], self._model_path,
+                                            ANALYSIS_PARAMETERS['min_confidence'], self._batch_size, self._pad)
+            except Exception as error:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+
+            for (_, future, _), net_results in zip(batch, results):
+                future.set_result(net_results)
+
+
+class AnalysisService:
+    def __init__(self, model_path, batch_size=8, max_wait=0.01, pad=False, mosaic_ocr=False, ocr_workers=1,
+                 stage_workers=4, tiles=None):
+        self.model_path = model_path
+        self.mosaic_ocr = mosaic_ocr
+        self.ocr_workers = ocr_workers
+        self.stage_workers = stage_workers
+        self.tiles = tiles
+
+        # Everything slow to start is loaded once, before the first request
+        get_text_detector(model_path)
+        get_ocr_backend()
+
+        self.batcher = TextDetectionBatcher(model_path, batch_size, max_wait, pad)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._started = time.time()
+
+    def analyze(self, image):
+        with self._lock:
+            self._in_flight += 1
+        start = time.perf_counter()
+        try:
+            # Tiled images have a text detection of their own, everything else goes through the shared batches. The
+            # batch and the other stages share the context of the image.
+            context = image_context(image)
+            if needs_tiling(context, self.tiles):
+                return analyze_image(context, self.model_path, mosaic_ocr=self.mosaic_ocr,
+                                     ocr_workers=self.ocr_workers, stage_workers=self.stage_workers, tiles=self.tiles)
+            return analyze_text_future(context, self.batcher.submit(context), mosaic_ocr=self.mosaic_ocr,
+                                       ocr_workers=self.ocr_workers, stage_workers=self.stage_workers)
+        finally:
+            observe('server_request', time.perf_counter() - start)
+            with self._lock:
+                self._in_flight -= 1
+
+    def stats(self):
+        metrics = get_metrics()
+
+        def latency(name):
+            histogram = metrics.histogram(name)
+            if histogram is None:
+                return {'count': 0, 'mean': None, 'median': None, 'p95': None}
+            return {'count': histogram.count, 'mean': histogram.sum / histogram.count,
+                    'median': histogram.quantile(0.5), 'p95': histogram.quantile(0.95)}
+
+        batches = metrics.counter('server_batches')
+        with self._lock:
+            in_flight = self._in_flight
+        return {
+            'uptime': time.time() - self._started,
+            'queue_depth': self.batcher.queue_depth(),
+            'in_flight': in_flight,
+            'requests': metrics.counter('server_requests'),
+            'failures': metrics.counter('server_failures'),
+            'batches': batches,
+            'mean_batch_size': metrics.counter('server_batched_images') / batches if batches else None,
+            'latency': latency('server_request'),
+            'queue_wait': latency('server_queue_wait'),
+            'metrics': metrics.to_json(),
+        }
+
+    def close(self):
+        self.batcher.close()
+
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+    # POST /analyze with the encoded image (png, jpg, ...) as the body answers with the json of results.json,
+    # GET /stats with the queue and latency statistics
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/stats':
+            self._send_json(200, self.server.service.stats())
+        elif path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': f'Unknown path {path}'})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path != '/analyze':
+            self._send_json(404, {'error': f'Unknown path {path}'})
+            return
+
+        increment('server_requests')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+
+        image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR) if body else None
+        if image is None:
+            increment('server_failures')
+            self._send_json(400, {'error': 'The body is not an image'})
+            return
+
+        try:
+            results = self.server.service.analyze(image)
+        except Exception as error:
+            increment('server_failures')
+            log.exception('Could not analyze the image')
+            self._send_json(500, {'error': f'{type(error).__name__}: {error}'})
+            return
+
+        self._send_json(200, results)
+
+    def _send_json(self, status, document):
+        body = json.dumps(document, indent=2).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix socket'
+
+    def log_message(self, format, *args):
+        log.debug(f'{self.address_string()} {format % args}')
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(service, host='127.0.0.1', port=8080, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, AnalysisRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), AnalysisRequestHandler)
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep the models loaded and analyze the images sent over http')
+    parser.add_argument('--model_path', '-m', help='Path to the pb file for the neural network',
+                        default='other\\frozen_east_text_detection.pb')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--socket', help='Listen on this unix socket instead of a port')
+    parser.add_argument('--batch_size', type=int, default=8, help='Maximum number of images in a forward pass')
+    parser.add_argument('--batch_wait', type=float, default=10,
+                        help='Milliseconds a request waits for others to share its forward pass')
+    parser.add_argument('--pad', action='store_true',
+                        help='Pad images of different sizes to batch them together, the results of the padded images '
+                             'can differ slightly from results.json')
+    parser.add_argument('--ocr_backend', choices=sorted(OCR_BACKENDS), default=DEFAULT_OCR_BACKEND,
+                        help='OCR engine to use, tesserocr keeps the language model loaded between regions')
+    parser.add_argument('--mosaic_ocr', action='store_true',
+                        help='Recognize all the labels of an image in a single OCR call on a mosaic of the regions')
+    parser.add_argument('--ocr_workers', type=int, default=1, metavar='N',
+                        help='Number of regions of an image recognized at the same time')
+    parser.add_argument('--tile_size', type=int, default=0,
+                        help='Analyze images larger than this in overlapping tiles of at most this size, like 1024 '
+                             'for captures too large for the network, 0 (the default) to disable')
+    parser.add_argument('--tile_overlap', type=int, default=128, help='Overlap in pixels between neighbouring tiles')
+    parser.add_argument('--tile_workers', type=int, default=1, help='Number of tiles analyzed at the same time')
+    args = parser.parse_args()
+
+    log.basicConfig(stream=sys.stdout, level=log.INFO, format=FORMAT)
+
+    set_default_ocr_backend(args.ocr_backend)
+    if args.tile_size and not 0 <= args.tile_overlap < args.tile_size:
+        parser.error('--tile_overlap must be at least 0 and less than --tile_size')
+    tiles = tiling(args.tile_size, args.tile_overlap, args.tile_workers) if args.tile_size else None
+
+    service = AnalysisService(args.model_path, args.batch_size, args.batch_wait / 1000, args.pad,
+                              args.mosaic_ocr, args.ocr_workers, tiles=tiles)
+    server = create_server(service, args.host, args.port, args.socket)
+    log.info(f'Listening on {args.socket or f"http://{args.host}:{args.port}"}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
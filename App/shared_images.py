@@ -0,0 +1,100 @@
+import logging
+import threading
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+import cv2
+import numpy as np
+
+# What a worker process needs to find an image in shared memory, a few dozen bytes to pickle whatever the image size
+image_descriptor = namedtuple('image_descriptor', 'name shape dtype')
+
+
+class SharedImageStore:
+    def __init__(self):
+        # The process that creates the buffers owns them. Every user of a buffer holds a reference and the buffer is
+        # unlinked when the last one is released.
+        self._buffers = {}
+        self._references = {}
+        self._lock = threading.Lock()
+
+        # Worker processes started after this share the resource tracker of the owner. With trackers of their own they
+        # would unlink the buffers they attached to when they exit.
+        resource_tracker.ensure_running()
+
+    def put(self, image, references=1):
+        image = np.asarray(image)
+        buffer = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+        np.ndarray(image.shape, image.dtype, buffer=buffer.buf)[...] = image
+
+        descriptor = image_descriptor(buffer.name, image.shape, image.dtype.str)
+        with self._lock:
+            self._buffers[buffer.name] = buffer
+            self._references[buffer.name] = references
+        return descriptor
+
+    def read(self, image_path, references=1):
+        # The image is decoded once, the copy into shared memory is the only other copy it ever gets
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f'{image_path} could not be read')
+        return self.put(image, references)
+
+    def view(self, descriptor):
+        with self._lock:
+            buffer = self._buffers[descriptor.name]
+        return np.ndarray(descriptor.shape, np.dtype(descriptor.dtype), buffer=buffer.buf)
+
+    def acquire(self, descriptor):
+        with self._lock:
+            self._references[descriptor.name] += 1
+
+    def release(self, descriptor):
+        with self._lock:
+            self._references[descriptor.name] -= 1
+            if self._references[descriptor.name]:
+                return
+            del self._references[descriptor.name]
+            buffer = self._buffers.pop(descriptor.name)
+        _close(buffer)
+        buffer.unlink()
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def close(self):
+        # Releases every buffer, whatever its references
+        with self._lock:
+            buffers = list(self._buffers.values())
+            self._buffers = {}
+            self._references = {}
+        for buffer in buffers:
+            _close(buffer)
+            buffer.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _close(buffer):
+    try:
+        buffer.close()
+    except BufferError:
+        # A view of the image is still alive somewhere, the mapping goes away with the process
+        logging.warning(f'Shared image {buffer.name} is still in use, keeping it mapped')
+
+
+def with_shared_image(descriptor, function, *args, **kwargs):
+    # Calls function with the image as a view of the shared buffer, without a copy, and crops of it are views too.
+    # The buffer is unmapped when the function returns, so the function must not keep the view. Other processes may
+    # hold references to the same buffer, the view is read-only and a function drawing on the image needs a copy.
+    buffer = shared_memory.SharedMemory(name=descriptor.name)
+    try:
+        image = np.ndarray(descriptor.shape, np.dtype(descriptor.dtype), buffer=buffer.buf)
+        image.flags.writeable = False
+        return function(image, *args, **kwargs)
+    finally:
+        _close(buffer)
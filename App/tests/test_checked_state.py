@@ -0,0 +1,90 @@
+import argparse
+import logging
+import random
+import time
+
+import cv2
+import numpy as np
+
+from detection import ImageContext, are_circles_checked, are_squares_checked, is_checked
+from utils import circle, point, rectangle
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def random_page(count, width, height, rng):
+    # A light page with dark check boxes and radio buttons, some of them filled, a few cut by the border of the page
+    image = np.full((height, width, 3), 235, dtype=np.uint8)
+    squares, circles = [], []
+    for _ in range(count):
+        x, y = rng.randint(-4, width - 10), rng.randint(-4, height - 10)
+        filled = rng.random() < 0.5
+        if rng.random() < 0.5:
+            size = rng.randint(8, 13)
+            squares.append(rectangle(x, y, size, size))
+            cv2.rectangle(image, (x, y), (x + size - 1, y + size - 1), (40, 40, 40), 1)
+            if filled:
+                cv2.rectangle(image, (x + 2, y + 2), (x + size - 3, y + size - 3), (40, 40, 40), -1)
+        else:
+            radius = rng.randint(6, 8)
+            circles.append(circle(point(x + radius, y + radius), radius))
+            cv2.circle(image, (x + radius, y + radius), radius - 1, (40, 40, 40), 1)
+            if filled:
+                cv2.circle(image, (x + radius, y + radius), radius - 3, (40, 40, 40), -1)
+    return image, squares, circles
+
+
+def classify(image, squares, circles, use_table):
+    # The Otsu plane is shared by both ways of counting, only the counting is timed
+    context = ImageContext(image)
+    context.otsu()
+    old = time.perf_counter()
+    results = are_squares_checked(context, squares, 0.8, use_table).tolist() + \
+        are_circles_checked(context, circles, 0.75, use_table).tolist()
+    return results, time.perf_counter() - old
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counts', type=int, nargs='+', default=[20, 100, 200, 500, 1000, 5000],
+                        help='Number of toggles on the random pages')
+    parser.add_argument('--width', type=int, default=1920, help='Width of the random pages')
+    parser.add_argument('--height', type=int, default=1080, help='Height of the random pages')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random pages')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    identical = True
+    print(f'{"toggles":>8}{"per crop otsu (s)":>19}{"crops (s)":>11}{"table (s)":>11}{"chosen (s)":>12}{"agree":>7}'
+          f'{"same":>6}')
+    for count in args.counts:
+        image, squares, circles = random_page(count, args.width, args.height, rng)
+        gray = ImageContext(image).gray()
+
+        # The classification before, with an Otsu threshold of its own for every crop
+        old = time.perf_counter()
+        per_crop_otsu = [is_checked(gray[max(0, s.y):s.y + s.h, max(0, s.x):s.x + s.w], 0.8) for s in squares] + \
+            [is_checked(gray[max(0, c.center.y - c.radius):c.center.y + c.radius,
+                             max(0, c.center.x - c.radius):c.center.x + c.radius], 0.75) for c in circles]
+        per_crop_otsu_time = time.perf_counter() - old
+
+        # The white pixels of the Otsu threshold of the whole image, one crop at a time, in the summed-area table
+        # and whichever of the two the number of toggles calls for
+        crops, crops_time = classify(image, squares, circles, False)
+        table, table_time = classify(image, squares, circles, True)
+        chosen, chosen_time = classify(image, squares, circles, None)
+
+        same = crops == table == chosen
+        identical = identical and same
+        agreeing = sum(result == before for result, before in zip(table, per_crop_otsu)) / len(table)
+        print(f'{len(table):>8}{per_crop_otsu_time:>19.4f}{crops_time:>11.4f}{table_time:>11.4f}{chosen_time:>12.4f}'
+              f'{agreeing:>7.1%}{str(same):>6}')
+
+    logging.warning(f'Identical output: {identical}')
+    if not identical:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from detection import decode_predictions
+
+logging.basicConfig(level=logging.INFO)
+
+
+def decode_predictions_loop(scores, geometry, min_confidence):
+    # The original cell by cell decoder, kept as the reference for the vectorized one
+    (numRows, numCols) = scores.shape[2:4]
+    rects = []
+    confidences = []
+
+    for y in range(0, numRows):
+        scores_data = scores[0, 0, y]
+        x_data0 = geometry[0, 0, y]
+        x_data1 = geometry[0, 1, y]
+        x_data2 = geometry[0, 2, y]
+        x_data3 = geometry[0, 3, y]
+        angles_data = geometry[0, 4, y]
+
+        for x in range(0, numCols):
+            if scores_data[x] < min_confidence:
+                continue
+
+            (offsetX, offsetY) = (x * 4.0, y * 4.0)
+
+            angle = angles_data[x]
+            cos = np.cos(angle)
+            sin = np.sin(angle)
+
+            # The products and sums of the float32 maps are float32, anything mixed with the Python offsets is float64
+            # like NumPy 1.x promoted scalars. NumPy 2 would keep all of it in float32.
+            h = np.float64(x_data0[x] + x_data2[x])
+            w = np.float64(x_data1[x] + x_data3[x])
+
+            end_x = int(offsetX + np.float64(cos * x_data1[x]) + np.float64(sin * x_data2[x]))
+            end_y = int(offsetY - np.float64(sin * x_data1[x]) + np.float64(cos * x_data2[x]))
+            start_x = int(end_x - w)
+            start_y = int(end_y - h)
+
+            rects.append((start_x, start_y, end_x, end_y))
+            confidences.append(scores_data[x])
+
+    return rects, confidences
+
+
+def random_predictions(height, width, seed):
+    # Same layout as the EAST output layers for an image of height x width pixels
+    rng = np.random.default_rng(seed)
+    rows, cols = height // 4, width // 4
+
+    scores = rng.random((1, 1, rows, cols), dtype=np.float32)
+    geometry = np.empty((1, 5, rows, cols), dtype=np.float32)
+    geometry[0, :4] = rng.random((4, rows, cols), dtype=np.float32) * 40
+    geometry[0, 4] = (rng.random((rows, cols), dtype=np.float32) - 0.5) * np.pi / 2
+
+    return scores, geometry
+
+
+def measure(function, repeat, *args):
+    durations = []
+    for _ in range(repeat):
+        old = time.perf_counter()
+        result = function(*args)
+        durations.append(time.perf_counter() - old)
+    return result, min(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--height', type=int, default=1088, help='Height of the image fed to the network')
+    parser.add_argument('--width', type=int, default=1920, help='Width of the image fed to the network')
+    parser.add_argument('--min_confidence', type=float, default=0.1, help='Minimum confidence for text position')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs for each decoder')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random score and geometry maps')
+    args = parser.parse_args()
+
+    scores, geometry = random_predictions(args.height, args.width, args.seed)
+
+    (loop_rects, loop_confidences), loop_time = measure(decode_predictions_loop, args.repeat,
+                                                        scores, geometry, args.min_confidence)
+    (rects, confidences), vectorized_time = measure(decode_predictions, args.repeat,
+                                                    scores, geometry, args.min_confidence)
+
+    identical = [tuple(rect) for rect in rects.tolist()] == loop_rects and \
+        np.array_equal(confidences, np.array(loop_confidences, dtype=np.float32))
+
+    logging.info(f'Decoded {len(loop_rects)} boxes from a {scores.shape[2]}x{scores.shape[3]} score map')
+    logging.info(f'Loop decoder: {loop_time:.4f} seconds')
+    logging.info(f'Vectorized decoder: {vectorized_time:.4f} seconds ({loop_time / vectorized_time:.1f}x faster)')
+    logging.info(f'Identical output: {identical}')
+
+    if not identical:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
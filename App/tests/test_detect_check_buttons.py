@@ -3,7 +3,7 @@ import json
 
 import cv2
 
-from detection import detect_rectangles, detect_text, join_padded_rectangles, detect_check_buttons
+from detection import ImageContext, detect_rectangles, detect_text, join_padded_rectangles, detect_check_buttons
 
 
 def main():
@@ -13,19 +13,17 @@ def main():
     args = parser.parse_args()
 
     image = cv2.imread(args.image_path)
+    context = ImageContext(image)
 
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-    processed = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-
-    rects = detect_rectangles(processed, 50, 0.0)
+    rects = detect_rectangles(context, 50, 0.0)
+    # The text detection and the check buttons read the planes derived before the rectangles are drawn
+    net_results = detect_text(context, args.model_path, 0.1)
     for rect in rects:
         cv2.rectangle(image, (rect.x, rect.y), (rect.x + rect.w, rect.y + rect.h), (0, 0, 255), 2)
 
-    net_results = detect_text(image, args.model_path, 0.1)
     text_rects = join_padded_rectangles(net_results, (0.05, 0.05), image.shape[:2])
 
-    results = detect_check_buttons(gray, rects, text_rects)
+    results = detect_check_buttons(context, rects, text_rects)
 
     for start_x, start_y, w, h in text_rects:
         cv2.rectangle(image, (start_x, start_y), (start_x + w, start_y + h), (0, 0, 0), 2)
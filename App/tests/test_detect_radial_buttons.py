@@ -3,7 +3,7 @@ import json
 
 import cv2
 
-from detection import detect_text, join_padded_rectangles, detect_radial_buttons
+from detection import ImageContext, detect_text, join_padded_rectangles, detect_radial_buttons
 
 RADIAL_BUTTON_PARAM1 = 14
 RADIAL_BUTTON_PARAM2 = 30
@@ -16,16 +16,15 @@ def main():
     args = parser.parse_args()
 
     image = cv2.imread(args.image_path)
+    context = ImageContext(image)
 
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-    net_results = detect_text(image, args.model_path, 0.8)
+    net_results = detect_text(context, args.model_path, 0.8)
     text_rects = join_padded_rectangles(net_results, (0.4, 0.1), image.shape[:2])
 
     # for start_x, start_y, w, h in text_rects:
         # cv2.rectangle(image, (start_x, start_y), (start_x + w, start_y + h), (0, 0, 0), 2)
 
-    results = detect_radial_buttons(gray, text_rects)
+    results = detect_radial_buttons(context, text_rects)
 
     for button in results:
         circ = button['button_circle']
@@ -5,7 +5,7 @@ import sys
 
 import cv2
 import numpy
-from detection import detect_rectangles
+from detection import ImageContext, detect_rectangles
 
 
 FORMAT = '[%(asctime)s] [%(levelname)s] : %(message)s'
@@ -39,8 +39,6 @@ approx_to_string = {
 
 
 def operation(_):
-    processed = cv2.adaptiveThreshold(gray_image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-
     image = original.copy()
 
     approximation_type_n = cv2.getTrackbarPos(APPROX_TRACKBAR_TITLE, WINDOW_TITLE)
@@ -54,7 +52,7 @@ def operation(_):
     area_thresh = cv2.getTrackbarPos(AREA_TRACKBAR_TITLE, WINDOW_TITLE)
     logging.info(f'Area threshold: {area_thresh}')
 
-    results = detect_rectangles(processed, area_thresh, coef)
+    results = detect_rectangles(context, area_thresh, coef)
 
     for r in results:
         rect_points = [(r.x, r.y), (r.x + r.w, r.y), (r.x + r.w, r.y + r.h), (r.x, r.y + r.h)]
@@ -79,8 +77,8 @@ if not os.path.isfile(args.image_path):
 
 original = cv2.imread(args.image_path)
 
-logging.info('Converting to gray')
-gray_image = cv2.cvtColor(original, cv2.COLOR_BGR2GRAY)
+# The gray and thresholded planes are computed once, not every time a trackbar moves
+context = ImageContext(original)
 
 cv2.namedWindow(WINDOW_TITLE)
 cv2.createTrackbar(COEF_TRACKBAR_TITLE, WINDOW_TITLE, 0, 100, operation)
@@ -0,0 +1,99 @@
+import argparse
+import glob
+import itertools
+import logging
+import os
+import time
+
+import cv2
+
+from detection import ImageContext, detect_rectangles
+from utils import rectangle
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def detect_rectangles_per_contour(image, area_thresh, coef, approximation_type=cv2.CHAIN_APPROX_SIMPLE):
+    # The original per contour implementation, kept as the reference for the vectorized one
+    contours, _ = cv2.findContours(image, cv2.RETR_LIST, approximation_type)
+
+    results = set()
+    for contour in contours:
+        approx = cv2.approxPolyDP(contour, coef * cv2.arcLength(contour, True), True)
+
+        if len(approx) != 4:
+            continue
+
+        ((x11, y11),), ((x12, y12),), ((x21, y21),), ((x22, y22),) = approx
+
+        w1 = x22 - x11
+        w2 = x21 - x12
+        h1 = y12 - y11
+        h2 = y21 - y22
+
+        diff = abs(w1 - w2)
+        if diff > 0.1 * w1 or diff > 0.1 * w2:
+            continue
+
+        diff = abs(h1 - h2)
+        if diff > 0.1 * h1 or diff > 0.1 * h2:
+            continue
+
+        thresh_x = (x22 - x11) * 0.1
+        thresh_y = (y12 - y11) * 0.1
+        if any([
+            abs(x11 - x12) > thresh_x,
+            abs(x22 - x21) > thresh_x,
+            abs(y11 - y22) > thresh_y,
+            abs(y12 - y21) > thresh_y
+        ]):
+            continue
+
+        if cv2.contourArea(approx) > area_thresh:
+            x, y, w, h = cv2.boundingRect(approx)
+            results.add(rectangle(x, y, w, h))
+
+    to_remove = set()
+    for rect1, rect2 in itertools.combinations(results, 2):
+        if rect1 not in to_remove and \
+                rect1.x == rect2.x and rect1.y == rect2.y and rect1.w == rect2.w and rect1.h == rect2.h:
+            to_remove.add(rect1)
+
+    return results.difference(to_remove)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('images', nargs='*', help='Images to analyze, all the test images by default')
+    parser.add_argument('--area_thresh', type=int, default=50, help='Minimum area of a rectangle')
+    parser.add_argument('--coef', type=float, default=0.0, help='Polygon approximation coefficient')
+    args = parser.parse_args()
+
+    image_paths = args.images or sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'test_images', '*')))
+
+    identical = True
+    print(f'{"image":<24}{"contours":>10}{"rects":>8}{"old (s)":>10}{"new (s)":>10}{"same":>6}')
+    for image_path in image_paths:
+        context = ImageContext(cv2.imread(image_path))
+        processed = context.adaptive_threshold(11, 2)
+
+        old = time.perf_counter()
+        expected = detect_rectangles_per_contour(processed, args.area_thresh, args.coef)
+        old_time = time.perf_counter() - old
+
+        old = time.perf_counter()
+        results = detect_rectangles(context, args.area_thresh, args.coef)
+        new_time = time.perf_counter() - old
+        contours = context.contours(11, 2)
+
+        same = results == expected
+        identical = identical and same
+        print(f'{os.path.basename(image_path):<24}{len(contours):>10}{len(results):>8}'
+              f'{old_time:>10.4f}{new_time:>10.4f}{str(same):>6}')
+
+    if not identical:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
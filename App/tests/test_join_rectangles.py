@@ -0,0 +1,90 @@
+import argparse
+import itertools
+import logging
+import random
+import time
+
+from detection import join_overlapping_rectangles
+from utils import join, overlap, rectangle
+
+logging.basicConfig(level=logging.INFO)
+
+
+def join_overlapping_rectangles_pairwise(results):
+    # The original fixed point pairwise joining, kept as the reference for the merge engine
+    results = sorted(results, key=lambda r: r.x)
+
+    joined = set()
+    processed = set()
+
+    while True:
+        found_overlap = False
+        for rect1, rect2 in itertools.combinations(results, 2):
+            if rect1 not in processed and rect2 not in processed:
+                if overlap(rect1, rect2):
+                    joined.add(join(rect1, rect2))
+                    processed.add(rect1)
+                    processed.add(rect2)
+                    found_overlap = True
+
+        for rect in results:
+            if rect not in processed:
+                joined.add(rect)
+
+        if not found_overlap:
+            break
+        else:
+            results = joined
+            joined = set()
+            processed = set()
+
+    return joined
+
+
+def random_text_boxes(count, width, height, rng):
+    # Short and wide boxes, similar to the padded EAST results on a dense text screen
+    boxes = []
+    for _ in range(count):
+        w = rng.randint(5, 80)
+        h = rng.randint(8, 20)
+        boxes.append(rectangle(rng.randint(0, width - w), rng.randint(0, height - h), w, h))
+    return boxes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=400, help='Number of boxes in each random screen')
+    parser.add_argument('--screens', type=int, default=20, help='Number of random screens to compare on')
+    parser.add_argument('--width', type=int, default=1920, help='Width of the random screens')
+    parser.add_argument('--height', type=int, default=1080, help='Height of the random screens')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random boxes')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    pairwise_time = 0
+    engine_time = 0
+    identical = True
+    for _ in range(args.screens):
+        boxes = random_text_boxes(args.count, args.width, args.height, rng)
+
+        old = time.perf_counter()
+        expected = join_overlapping_rectangles_pairwise(boxes)
+        pairwise_time += time.perf_counter() - old
+
+        old = time.perf_counter()
+        joined = join_overlapping_rectangles(boxes)
+        engine_time += time.perf_counter() - old
+
+        identical = identical and joined == expected
+
+    logging.info(f'Pairwise joining: {pairwise_time:.4f} seconds')
+    logging.info(f'Merge engine: {engine_time:.4f} seconds ({pairwise_time / engine_time:.1f}x faster)')
+    logging.info(f'Identical output: {identical}')
+
+    if not identical:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@ import logging
 
 import cv2
 
-from detection import detect_text, join_padded_rectangles, apply_ocr_on_rects
+from detection import ImageContext, detect_text, join_padded_rectangles, apply_ocr_on_rects
 from utils import timer
 
 logging.basicConfig(level=logging.INFO)
@@ -23,13 +23,14 @@ def main():
     args = parser.parse_args()
 
     original_image = cv2.imread(args.image_path)
+    context = ImageContext(original_image)
 
-    net_results = detect_text(original_image, args.model_path, 0.8)
+    net_results = detect_text(context, args.model_path, 0.8)
     results = join_padded_rectangles(net_results, args.join_padding, original_image.shape[:2])
 
     if args.apply_ocr:
         with timer('Apply OCR on rects'):
-            ocr_results = apply_ocr_on_rects(original_image, results, args.ocr_padding)
+            ocr_results = apply_ocr_on_rects(context, results, args.ocr_padding)
 
         ocr_results = sorted(ocr_results, key=lambda r: r[0][1])
 
@@ -0,0 +1,144 @@
+import argparse
+import itertools
+import logging
+import random
+import time
+
+import numpy as np
+
+from detection import ImageContext, detect_buttons, detect_check_buttons, detect_radial_buttons, is_checked
+from utils import circle, is_inside_circle, is_rect_inside_rect, overlap, point, rectangle
+
+logging.basicConfig(level=logging.INFO)
+
+
+def detect_buttons_product(image, rects, text_rects):
+    # The original matchers, going through every pair, kept as the reference for the spatial index
+    rects_to_remove = set()
+    for inner_rect, outer_rect in itertools.combinations(rects, 2):
+        if inner_rect not in rects_to_remove \
+                and outer_rect not in rects_to_remove \
+                and is_rect_inside_rect(inner_rect, outer_rect):
+            rects_to_remove.add(outer_rect)
+
+    rects = set(rects).difference(rects_to_remove)
+    horizontal_rects = [rect for rect in rects if rect.w > rect.h]
+
+    results = []
+    checked_rects = set()
+    checked_text_rects = set()
+
+    for text_rect, rect in itertools.product(text_rects, horizontal_rects):
+        if rect not in checked_rects and text_rect not in checked_text_rects and \
+                overlap(text_rect, rect) > 0.8 and abs(text_rect.h - rect.h) < 0.5 * rect.h:
+            checked_rects.add(rect)
+            checked_text_rects.add(text_rect)
+
+            results.append({
+                'text_rectangle': text_rect.to_json(),
+                'rectangle': rect.to_json()
+            })
+    return results
+
+
+def detect_check_buttons_product(gray, rects, text_rects):
+    squares = [rect for rect in rects if abs(rect.w - rect.h) < 20 and rect.w * rect.h < 200]
+    first_results = []
+
+    processed_squares = set()
+    for rect, square in itertools.product(text_rects, squares):
+        if abs(square.y - rect.y) < 10 and square not in processed_squares:
+            if is_inside_circle(point(rect.x, rect.y),
+                                circle(point(square.x + square.w / 2, square.y + square.h / 2), 4 * square.w)):
+                first_results.append((rect, square))
+            else:
+                first_results.append((None, square))
+
+            processed_squares.add(square)
+
+    return [{
+        'associated_text_rect': rect.to_json() if rect else None,
+        'rectangle': square.to_json(),
+        'is_checked': is_checked(gray[square.y: square.y + square.h, square.x: square.x + square.w], 0.8)
+    } for rect, square in first_results]
+
+
+def detect_radial_buttons_product(gray, text_rects, circles):
+    first_results = []
+    for rect, circ in itertools.product(text_rects, circles):
+        if circ.center.y > rect.y and is_inside_circle(point(rect.x, rect.y), circle(circ.center, circ.radius * 3)):
+            first_results.append((rect, circ))
+
+    return [{
+        'associated_text_rect': rect.to_json(),
+        'button_circle': circ.to_json(),
+        'is_checked': is_checked(gray[circ.center.y - circ.radius: circ.center.y + circ.radius,
+                                      circ.center.x - circ.radius: circ.center.x + circ.radius], 0.75)
+    } for rect, circ in first_results]
+
+
+def random_form(count, width, height, rng):
+    # Text boxes with a few rectangles around them, some check boxes and radio circles next to them
+    text_rects, rects, circles = [], [], []
+    for _ in range(count):
+        w, h = rng.randint(10, 120), rng.randint(8, 20)
+        x, y = rng.randint(30, width - w - 10), rng.randint(10, height - h - 10)
+        text_rects.append(rectangle(x, y, w, h))
+
+        kind = rng.randrange(4)
+        if kind == 0:
+            rects.append(rectangle(x - rng.randint(0, 4), y - rng.randint(0, 4), w + rng.randint(0, 8),
+                                   h + rng.randint(0, 8)))
+            rects.append(rectangle(x - 6, y - 6, w + 12, h + 12))
+        elif kind == 1:
+            size = rng.randint(8, 13)
+            rects.append(rectangle(x - rng.randint(12, 30), y + rng.randint(-12, 12), size, size))
+        elif kind == 2:
+            circles.append(circle(point(x - rng.randint(0, 20), y + rng.randint(-8, 12)), rng.randint(5, 8)))
+    return list(dict.fromkeys(text_rects)), set(rects), circles
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=1000, help='Number of text boxes in each random form')
+    parser.add_argument('--forms', type=int, default=5, help='Number of random forms to compare on')
+    parser.add_argument('--width', type=int, default=1920, help='Width of the random forms')
+    parser.add_argument('--height', type=int, default=1080, help='Height of the random forms')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random forms')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    image = np.full((args.height, args.width, 3), 255, dtype=np.uint8)
+    context = ImageContext(image)
+    gray = context.gray()
+
+    product_time = 0
+    index_time = 0
+    identical = True
+    for _ in range(args.forms):
+        text_rects, rects, circles = random_form(args.count, args.width, args.height, rng)
+
+        old = time.perf_counter()
+        expected = (detect_buttons_product(None, rects, text_rects),
+                    detect_check_buttons_product(gray, rects, text_rects),
+                    detect_radial_buttons_product(gray, text_rects, circles))
+        product_time += time.perf_counter() - old
+
+        old = time.perf_counter()
+        results = (detect_buttons(ImageContext(image.copy()), rects, text_rects),
+                   detect_check_buttons(context, rects, text_rects),
+                   detect_radial_buttons(context, text_rects, circles))
+        index_time += time.perf_counter() - old
+
+        identical = identical and results == expected
+
+    logging.info(f'Pairwise matching: {product_time:.4f} seconds')
+    logging.info(f'Spatial index: {index_time:.4f} seconds ({product_time / index_time:.1f}x faster)')
+    logging.info(f'Identical output: {identical}')
+
+    if not identical:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
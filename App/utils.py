@@ -1,7 +1,15 @@
 import contextlib
+import functools
+import heapq
 import logging
+import math
 import time
 from collections import namedtuple
+from concurrent import futures
+
+import numpy as np
+
+from metrics import observe, metric_name
 
 point = namedtuple('point', 'x y')
 circle = namedtuple('circle', 'center radius')
@@ -37,13 +45,90 @@ rectangle.from_json = rectangle_from_json
 
 
 @contextlib.contextmanager
-def timer(operation_name):
-    old = time.time()
+def timer(operation_name, metric=None):
+    # The duration also goes to the histogram of the metric, named after the operation unless it is given
+    old = time.perf_counter()
     yield
-    diff = time.time() - old
+    diff = time.perf_counter() - old
+    observe(metric or metric_name(operation_name), diff)
     logging.info(f'{operation_name} finished in {diff:.4f} seconds')
 
 
+def run_stage_graph(stages, max_workers=None):
+    # stages maps a name to (function, dependency names), the function gets the results of its dependencies as
+    # arguments. Every stage starts as soon as all of its dependencies are done.
+    results = {}
+    pending = dict(stages)
+    running = {}
+
+    with futures.ThreadPoolExecutor(max_workers) as executor:
+        while pending or running:
+            for name, (function, dependencies) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    del pending[name]
+                    running[executor.submit(_run_stage, name, function,
+                                            *[results[dependency] for dependency in dependencies])] = name
+
+            if not running:
+                raise ValueError(f'The stages {", ".join(pending)} depend on missing or circular stages')
+
+            done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return results
+
+
+def _run_stage(name, function, *args):
+    with timer(f'Stage {name}'):
+        return function(*args)
+
+
+class GridIndex:
+    def __init__(self, rects, cell_size=64):
+        # Every rectangle is registered in all the cells of a uniform grid that it covers
+        self._cell_size = cell_size
+        self._cells = {}
+
+        for index, (x, y, w, h) in enumerate(rects):
+            for cell_y in range(self._cell(y), self._cell(y + h) + 1):
+                for cell_x in range(self._cell(x), self._cell(x + w) + 1):
+                    self._cells.setdefault((cell_x, cell_y), []).append(index)
+
+        if self._cells:
+            self._min_cell = tuple(min(cell[i] for cell in self._cells) for i in range(2))
+            self._max_cell = tuple(max(cell[i] for cell in self._cells) for i in range(2))
+
+    def _cell(self, coordinate):
+        return math.floor(coordinate / self._cell_size)
+
+    def _cell_range(self, start, end, axis):
+        start = self._min_cell[axis] if start == -math.inf else max(self._min_cell[axis], self._cell(start))
+        end = self._max_cell[axis] if end == math.inf else min(self._max_cell[axis], self._cell(end))
+        return range(start, end + 1)
+
+    def query(self, x1=-math.inf, y1=-math.inf, x2=math.inf, y2=math.inf):
+        # Indices of the rectangles that may touch the box, in insertion order. The caller does the exact check.
+        if not self._cells:
+            return []
+
+        found = set()
+        for cell_y in self._cell_range(y1, y2, 1):
+            for cell_x in self._cell_range(x1, x2, 0):
+                found.update(self._cells.get((cell_x, cell_y), ()))
+        return sorted(found)
+
+    def query_pairs(self, boxes):
+        # (box index, rectangle index) of the candidate pairs of all the boxes, as two arrays in the order of
+        # itertools.product
+        first, second = [], []
+        for index, box in enumerate(boxes):
+            found = self.query(*box)
+            first.extend([index] * len(found))
+            second.extend(found)
+        return np.array(first, dtype=np.intp), np.array(second, dtype=np.intp)
+
+
 def overlap(r1: rectangle, r2: rectangle):
     x11, y11, w1, h1 = r1
     x21, y21, w2, h2 = r2
@@ -77,12 +162,7 @@ def join(r1: rectangle, r2: rectangle):
 
 
 def is_point_inside_rect(p: point, r: rectangle):
-    return all([
-        p.x > r.x,
-        p.y > r.y,
-        p.x < r.x + r.w,
-        p.y < r.y + r.h
-    ])
+    return r.x < p.x < r.x + r.w and r.y < p.y < r.y + r.h
 
 
 def is_inside_circle(p: point, c: circle):
@@ -90,9 +170,165 @@ def is_inside_circle(p: point, c: circle):
 
 
 def is_rect_inside_rect(r1: rectangle, r2: rectangle):
-    return all([
-        r1.x > r2.x,
-        r1.y > r2.y,
-        r1.x + r1.w < r2.x + r2.w,
-        r1.y + r1.h < r2.y + r2.h
-    ])
+    return r1.x > r2.x and r1.y > r2.y and r1.x + r1.w < r2.x + r2.w and r1.y + r1.h < r2.y + r2.h
+
+
+class RectArray:
+    def __init__(self, x, y, w, h):
+        # Struct of arrays, indexing it indexes all four arrays. Any shape works, so rects[:, None] against
+        # rects[None, :] compares every pair.
+        self.x = np.asarray(x, dtype=np.int32)
+        self.y = np.asarray(y, dtype=np.int32)
+        self.w = np.asarray(w, dtype=np.int32)
+        self.h = np.asarray(h, dtype=np.int32)
+
+    @classmethod
+    def from_rects(cls, rects):
+        values = np.array(list(rects), dtype=np.int32).reshape(-1, 4)
+        return cls(*values.T)
+
+    def to_rects(self):
+        return list(map(rectangle, self.x.tolist(), self.y.tolist(), self.w.tolist(), self.h.tolist()))
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        return RectArray(self.x[index], self.y[index], self.w[index], self.h[index])
+
+    def _bounds(self):
+        # int64, so the areas of large rectangles don't overflow
+        x, y = self.x.astype(np.int64), self.y.astype(np.int64)
+        return x, y, x + self.w, y + self.h
+
+
+def overlap_ratios(r1: RectArray, r2: RectArray):
+    # Same as overlap, for every element of the broadcast arrays
+    x11, y11, x12, y12 = r1._bounds()
+    x21, y21, x22, y22 = r2._bounds()
+
+    d1 = np.minimum(y12, y22) - np.maximum(y11, y21)
+    d2 = np.minimum(x12, x22) - np.maximum(x11, x21)
+    overlapping = (d1 > 0) & (d2 > 0)
+
+    smaller_area = np.minimum((x12 - x11) * (y12 - y11), (x22 - x21) * (y22 - y21))
+    return np.divide(d1 * d2, smaller_area, out=np.zeros(overlapping.shape), where=overlapping)
+
+
+def overlap_matrix(r1: RectArray, r2: RectArray):
+    return overlap_ratios(r1[:, None], r2[None, :])
+
+
+def are_rects_inside_rects(r1: RectArray, r2: RectArray):
+    x11, y11, x12, y12 = r1._bounds()
+    x21, y21, x22, y22 = r2._bounds()
+    return (x11 > x21) & (y11 > y21) & (x12 < x22) & (y12 < y22)
+
+
+def containment_matrix(r1: RectArray, r2: RectArray):
+    # Element i, j tells if r1[i] is inside r2[j]
+    return are_rects_inside_rects(r1[:, None], r2[None, :])
+
+
+def are_points_inside_circles(x, y, center_x, center_y, radius):
+    x, y = np.asarray(x), np.asarray(y)
+    return (x - center_x) ** 2 + (y - center_y) ** 2 < np.asarray(radius) ** 2
+
+
+def inside_circle_matrix(x, y, center_x, center_y, radius):
+    # Element i, j tells if point i is inside circle j
+    return are_points_inside_circles(np.asarray(x)[:, None], np.asarray(y)[:, None], np.asarray(center_x)[None, :],
+                                     np.asarray(center_y)[None, :], np.asarray(radius)[None, :])
+
+
+def rect_sums(integral, x, y, w, h):
+    # Sum and area of the part of every rectangle inside the image, four lookups in the summed-area table each
+    height, width = integral.shape[0] - 1, integral.shape[1] - 1
+    x, y = np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64)
+    x1, x2 = np.clip(x, 0, width), np.clip(x + w, 0, width)
+    y1, y2 = np.clip(y, 0, height), np.clip(y + h, 0, height)
+
+    sums = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+    return sums, (x2 - x1) * (y2 - y1)
+
+
+def circle_sums(integral, center_x, center_y, radius):
+    # The same for the pixels whose center is inside every circle. Each of the 2 * radius rows of a circle is a
+    # rectangle one pixel high, as wide as the circle at the height of the row.
+    center_x, center_y, radius = (np.asarray(values, dtype=np.int64).reshape(-1, 1)
+                                  for values in (center_x, center_y, radius))
+    rows = np.arange(2 * int(radius.max(initial=0)))[None, :]
+
+    y = center_y - radius + rows
+    half_width = np.sqrt(np.maximum(radius ** 2 - (y + 0.5 - center_y) ** 2, 0))
+    x1 = np.ceil(center_x - 0.5 - half_width).astype(np.int64)
+    x2 = np.floor(center_x - 0.5 + half_width).astype(np.int64) + 1
+    # The rows below the smaller circles are empty
+    x2 = np.where(rows < 2 * radius, x2, x1)
+
+    sums, areas = rect_sums(integral, x1, y, x2 - x1, 1)
+    return sums.sum(axis=1), areas.sum(axis=1)
+
+
+class DisjointSet:
+    def __init__(self, size):
+        self._parents = list(range(size))
+
+    def find(self, item):
+        root = item
+        while self._parents[root] != root:
+            root = self._parents[root]
+
+        # Path compression
+        while self._parents[item] != root:
+            self._parents[item], item = root, self._parents[item]
+
+        return root
+
+    def union(self, item1, item2):
+        root1, root2 = self.find(item1), self.find(item2)
+        if root1 != root2:
+            self._parents[max(root1, root2)] = min(root1, root2)
+
+    def groups(self):
+        groups = {}
+        for item in range(len(self._parents)):
+            groups.setdefault(self.find(item), []).append(item)
+        return list(groups.values())
+
+
+def overlapping_groups(rects):
+    # Sweep line over x: a rectangle can only overlap the rectangles that started before it and have not ended yet
+    order = sorted(range(len(rects)), key=lambda i: rects[i].x)
+    disjoint_set = DisjointSet(len(rects))
+
+    active = set()
+    ends = []
+    for i in order:
+        rect = rects[i]
+        while ends and ends[0][0] <= rect.x:
+            active.discard(heapq.heappop(ends)[1])
+
+        if rect.w <= 0 or rect.h <= 0:
+            continue
+
+        for j in active:
+            other = rects[j]
+            if min(rect.y + rect.h, other.y + other.h) - max(rect.y, other.y) > 0:
+                disjoint_set.union(i, j)
+
+        active.add(i)
+        heapq.heappush(ends, (rect.x + rect.w, i))
+
+    return [[rects[i] for i in group] for group in disjoint_set.groups()]
+
+
+def merge_overlapping_rectangles(rects):
+    # Joining a group can make its bounding box overlap other boxes, so merge until the boxes are disjoint
+    rects = list(set(rects))
+    while True:
+        groups = overlapping_groups(rects)
+        if len(groups) == len(rects):
+            return set(rects)
+
+        rects = list({functools.reduce(join, group) for group in groups})
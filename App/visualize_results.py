@@ -3,9 +3,14 @@ import json
 
 import cv2
 
+from detection import image_context
+from results_io import ResultsReader
 
-def visualize_results(image_path, results_path, debug=False):
-    result_image = cv2.imread(image_path)
+
+def visualize_results(image_path, results_path, debug=False, results_image=None, image=None):
+    # A caller that still has the analyzed image or its context passes it instead of having it read again. The results
+    # are drawn on a copy.
+    result_image = image_context(image).image.copy() if image is not None else cv2.imread(image_path)
 
     if debug:
         with open('debug.json', 'r') as file:
@@ -20,24 +25,30 @@ def visualize_results(image_path, results_path, debug=False):
                 cv2.rectangle(result_image, (rect['x'], rect['y']),
                               (rect['x'] + rect['w'], rect['y'] + rect['h']), (105, 105, 0), 2)
 
-    with open(results_path, 'r') as file:
-        results = json.load(file)
-        for button in results['buttons']:
-            rect = button['rectangle']
-            cv2.rectangle(result_image, (rect['x'], rect['y']),
-                          (rect['x'] + rect['w'], rect['y'] + rect['h']), (0, 255, 0), 2)
-
-        for button in results['check_buttons']:
-            rect = button['rectangle']
-            color = (255, 0, 0) if button['is_checked'] else (255, 100, 100)
-            cv2.rectangle(result_image, (rect['x'], rect['y']),
-                          (rect['x'] + rect['w'], rect['y'] + rect['h']), color, 2)
-
-        for button in results['radial_buttons']:
-            circ = button['button_circle']
-            color = (0, 100, 255) if button['is_checked'] else (100, 220, 255)
-            cv2.circle(result_image, (circ['center']['x'], circ['center']['y']),
-                       circ['radius'], color, 2)
+    # Any results format works. A file with the results of many images is looked up by results_image, the image path
+    # by default, and only the results of that image are parsed.
+    reader = ResultsReader(results_path)
+    if len(reader) > 1:
+        results = reader.get(results_image or image_path)
+    else:
+        results = reader.get()
+
+    for button in results['buttons']:
+        rect = button['rectangle']
+        cv2.rectangle(result_image, (rect['x'], rect['y']),
+                      (rect['x'] + rect['w'], rect['y'] + rect['h']), (0, 255, 0), 2)
+
+    for button in results['check_buttons']:
+        rect = button['rectangle']
+        color = (255, 0, 0) if button['is_checked'] else (255, 100, 100)
+        cv2.rectangle(result_image, (rect['x'], rect['y']),
+                      (rect['x'] + rect['w'], rect['y'] + rect['h']), color, 2)
+
+    for button in results['radial_buttons']:
+        circ = button['button_circle']
+        color = (0, 100, 255) if button['is_checked'] else (100, 220, 255)
+        cv2.circle(result_image, (circ['center']['x'], circ['center']['y']),
+                   circ['radius'], color, 2)
 
     return result_image
 
@@ -45,11 +56,13 @@ def visualize_results(image_path, results_path, debug=False):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('image_path', help='Path to image which generated the results')
-    parser.add_argument('results_path', help='Path to generated json file')
+    parser.add_argument('results_path', help='Path to the results: json, json lines or msgpack')
+    parser.add_argument('--results_image',
+                        help='Image whose results to show from a file with many images, the image path by default')
     parser.add_argument('--save', help='Save the resulting image to this path')
     args = parser.parse_args()
 
-    result_image = visualize_results(args.image_path, args.results_path)
+    result_image = visualize_results(args.image_path, args.results_path, results_image=args.results_image)
 
     cv2.imshow("Result", result_image)
     cv2.waitKey()